@@ -0,0 +1,85 @@
+import asyncio
+import re
+from logging.config import fileConfig
+
+from sqlalchemy.engine import Connection
+
+from alembic import context
+
+from config import settings
+from database import Model, engine
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Model.metadata
+
+# Объекты, которые создаются DDL-событиями database.py, а не метаданными моделей:
+# autogenerate не должен предлагать их удалить
+UNMAPPED_OBJECTS = {'search_vector', 'ix_book_search_vector', 'ix_author_full_name_trgm'}
+
+
+# Postgres хранит литерал даты в выражении индекса как '0001-01-01 00:00:00'::timestamp,
+# и текстовое сравнение autogenerate видит различие там, где его нет
+EXPRESSION_INDEXES = {'uq_author_identity'}
+
+# Секции borrow (partitions.py) и их индексы создаются вне метаданных моделей
+PARTITION_RE = re.compile(r'borrow_(\d{4}_\d{2}|default)')
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'index' and name in EXPRESSION_INDEXES:
+        return False
+    if type_ == 'table' and PARTITION_RE.fullmatch(name):
+        return False
+    if type_ == 'index' and PARTITION_RE.fullmatch(object.table.name):
+        return False
+    return not (reflected and compare_to is None and name in UNMAPPED_OBJECTS)
+
+
+def run_migrations_offline() -> None:
+    context.configure(
+        url=settings.get_db_url(),
+        target_metadata=target_metadata,
+        include_object=include_object,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection: Connection) -> None:
+    # Транзакция на каждую миграцию: autocommit_block для CREATE INDEX CONCURRENTLY
+    # коммитит только её, а не все предыдущие миграции разом
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        transaction_per_migration=True,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_async_migrations() -> None:
+    # Движок приложения: тот же URL из Settings и те же обработчики подключения
+    # (функции SQLite для выражений индексов)
+    async with engine.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+
+    await engine.dispose()
+
+
+def run_migrations_online() -> None:
+    asyncio.run(run_async_migrations())
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
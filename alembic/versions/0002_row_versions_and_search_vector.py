@@ -0,0 +1,45 @@
+"""row versions and book search vector
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 10:05:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from config import settings
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # server_default: существующие строки получают версию 1 без переписывания таблицы
+    op.add_column('author', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('book', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+    if op.get_bind().dialect.name == 'postgresql':
+        # Генерируемая колонка переписывает таблицу book один раз; индекс по ней
+        # строится в 0003 без блокировки записи
+        op.execute(
+            "ALTER TABLE book ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            f"setweight(to_tsvector('{settings.SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+            f"setweight(to_tsvector('{settings.SEARCH_CONFIG}', coalesce(description, '')), 'B')"
+            ") STORED"
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_column('book', 'search_vector')
+    op.drop_column('book', 'version')
+    op.drop_column('author', 'version')
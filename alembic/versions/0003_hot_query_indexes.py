@@ -0,0 +1,134 @@
+"""indexes for hot queries
+
+Before the unique identity indexes are built, duplicate authors and books
+are merged: books move to the surviving author, copies are summed into the
+surviving book and borrows are repointed to it. The merge is destructive and
+irreversible -- downgrade() drops the indexes but cannot restore merged rows.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 10:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Имя индекса и его определение после "ON". IF NOT EXISTS: базы, созданные
+# через create_all, часть этих индексов уже имеют
+INDEXES = [
+    # Внешние ключи: книги автора, выдачи книги (удаление автора и книги)
+    ('ix_book_author_id', 'book (author_id)'),
+    ('ix_borrow_book_id', 'borrow (book_id)'),
+    # Keyset-пагинация /books?order_by=title
+    ('ix_book_title_id', 'book (title, id)'),
+    # Открытые выдачи книги: закрытые, которых большинство, в индекс не попадают
+    ('ix_borrow_open_book_id', 'borrow (book_id) WHERE return_date IS NULL'),
+]
+
+# Составные ключи дедупликации для upsert-ов автора и книги (ON CONFLICT).
+# Выражения совпадают с AUTHOR_IDENTITY и BOOK_IDENTITY в database.py
+AUTHOR_IDENTITY = ("lower(btrim(coalesce(first_name, ''))), lower(btrim(coalesce(last_name, ''))), "
+                   "coalesce(birth_date, '0001-01-01')")
+BOOK_IDENTITY = 'coalesce(author_id, 0), lower(btrim(title))'
+
+UNIQUE_INDEXES = [
+    ('uq_author_identity', f'author ({AUTHOR_IDENTITY})'),
+    ('uq_book_identity', f'book ({BOOK_IDENTITY})'),
+]
+
+# Для каждой строки -- id строки с тем же ключом, которая остаётся (наименьший)
+AUTHOR_DUPLICATES = f'SELECT id, min(id) OVER (PARTITION BY {AUTHOR_IDENTITY}) AS keep_id FROM author'
+BOOK_DUPLICATES = f'SELECT id, available_copies, min(id) OVER (PARTITION BY {BOOK_IDENTITY}) AS keep_id FROM book'
+
+# Уникальный индекс не строится, пока в таблице есть дубликаты. Книги
+# дубликатов автора переходят к оставшемуся автору; у книг-дубликатов экземпляры
+# складываются, а выдачи переходят к оставшейся книге. Авторы сливаются первыми:
+# после этого могут появиться новые дубликаты книг
+MERGE_DUPLICATES = [
+    'UPDATE book SET author_id = dup.keep_id, version = version + 1 '
+    f'FROM ({AUTHOR_DUPLICATES}) AS dup WHERE book.author_id = dup.id AND dup.id <> dup.keep_id',
+    f'DELETE FROM author WHERE id IN (SELECT id FROM ({AUTHOR_DUPLICATES}) AS dup WHERE id <> keep_id)',
+    'UPDATE book SET available_copies = available_copies + extra.copies, version = version + 1 '
+    f'FROM (SELECT keep_id, sum(available_copies) AS copies FROM ({BOOK_DUPLICATES}) AS dup '
+    'WHERE id <> keep_id GROUP BY keep_id) AS extra WHERE book.id = extra.keep_id',
+    'UPDATE borrow SET book_id = dup.keep_id '
+    f'FROM ({BOOK_DUPLICATES}) AS dup WHERE borrow.book_id = dup.id AND dup.id <> dup.keep_id',
+    f'DELETE FROM book WHERE id IN (SELECT id FROM ({BOOK_DUPLICATES}) AS dup WHERE id <> keep_id)',
+]
+
+# Невалидный индекс остаётся после прерванного CREATE INDEX CONCURRENTLY.
+# IF NOT EXISTS его не перестраивает: такой индекс удаляют и строят заново
+INVALID_INDEX = sa.text('SELECT EXISTS (SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(:name) AND NOT indisvalid)')
+
+POSTGRES_INDEXES = [
+    # Полнотекстовый поиск /books/search
+    ('ix_book_search_vector', 'book USING gin (search_vector)'),
+]
+
+# Нечёткий поиск авторов, если в кластере есть pg_trgm
+TRGM_INDEX = (
+    'ix_author_full_name_trgm',
+    "author USING gin ((lower(btrim(coalesce(first_name, '') || ' ' || coalesce(last_name, '')))) gin_trgm_ops)",
+)
+
+
+def create_index_concurrently(bind, name: str, definition: str, unique: bool = False) -> None:
+    # Индекс, оставшийся невалидным после прошлой попытки, удаляется: иначе
+    # IF NOT EXISTS молча пропустит его и миграция отметится как выполненная
+    if bind.scalar(INVALID_INDEX, {'name': name}):
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    op.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    # Уже накопившиеся дубликаты сливаются до построения уникальных индексов
+    for statement in MERGE_DUPLICATES:
+        op.execute(statement)
+
+    if bind.dialect.name != 'postgresql':
+        for name, definition in UNIQUE_INDEXES:
+            op.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {definition}')
+        for name, definition in INDEXES:
+            op.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+        return
+
+    has_trgm = bind.scalar(sa.text("SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm')"))
+    if has_trgm:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # CONCURRENTLY не блокирует запись в таблицу, но не работает внутри транзакции.
+    # Если построение прервётся (например, дубликат вставлен уже после слияния),
+    # останется невалидный индекс: повторный запуск миграции его перестроит
+    with op.get_context().autocommit_block():
+        for name, definition in UNIQUE_INDEXES:
+            create_index_concurrently(bind, name, definition, unique=True)
+        for name, definition in INDEXES + POSTGRES_INDEXES:
+            create_index_concurrently(bind, name, definition)
+        if has_trgm:
+            create_index_concurrently(bind, *TRGM_INDEX)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Слитые в upgrade() дубликаты не восстанавливаются: откатываются только индексы
+    names = [name for name, _ in UNIQUE_INDEXES + INDEXES]
+    if op.get_bind().dialect.name != 'postgresql':
+        for name in names:
+            op.execute(f'DROP INDEX IF EXISTS {name}')
+        return
+
+    with op.get_context().autocommit_block():
+        for name in names + [name for name, _ in POSTGRES_INDEXES] + [TRGM_INDEX[0]]:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,120 @@
+"""partition borrow by borrow_date
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 12:30:00.000000
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from config import settings
+from partitions import DEFAULT_PARTITION_SQL, add_months, create_partition_sql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+COLUMNS = 'id, book_id, borrower_name, borrow_date, return_date'
+
+# Выдачи без даты через API не создаются; если такие строки есть, они уходят
+# в секцию по умолчанию, а откат возвращает им NULL
+MISSING_BORROW_DATE = "'0001-01-01'"
+
+INDEXES = [
+    ('ix_borrow_book_id', 'borrow (book_id)'),
+    ('ix_borrow_open_book_id', 'borrow (book_id) WHERE return_date IS NULL'),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    # SQLite секционирования не знает: таблица остаётся как есть
+    if bind.dialect.name != 'postgresql':
+        return
+
+    # Секционированную таблицу нельзя получить из обычной: создаётся новая, строки
+    # переносятся одним INSERT ... SELECT. Миграция держит эксклюзивную блокировку
+    # borrow до конца, её запускают в окно обслуживания
+    op.execute('LOCK TABLE borrow IN ACCESS EXCLUSIVE MODE')
+    op.execute('ALTER TABLE borrow RENAME TO borrow_unpartitioned')
+    op.execute('ALTER TABLE borrow_unpartitioned RENAME CONSTRAINT borrow_pkey TO borrow_unpartitioned_pkey')
+    for name, _ in INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+
+    op.execute(
+        'CREATE TABLE borrow ('
+        "id integer NOT NULL DEFAULT nextval('borrow_id_seq'), "
+        'book_id integer NOT NULL REFERENCES book (id), '
+        'borrower_name varchar NOT NULL, '
+        'borrow_date timestamp NOT NULL, '
+        'return_date timestamp, '
+        'PRIMARY KEY (id, borrow_date)'
+        ') PARTITION BY RANGE (borrow_date)'
+    )
+    op.execute('ALTER SEQUENCE borrow_id_seq OWNED BY borrow.id')
+    op.execute(DEFAULT_PARTITION_SQL)
+
+    # Секции только для месяцев, где уже есть выдачи, и для ближайших месяцев:
+    # пустые промежутки в истории покрывает секция по умолчанию
+    months = set(bind.scalars(sa.text(
+        "SELECT DISTINCT date_trunc('month', borrow_date)::date FROM borrow_unpartitioned "
+        'WHERE borrow_date IS NOT NULL'
+    )))
+    this_month = date.today().replace(day=1)
+    months.update(add_months(this_month, offset) for offset in range(settings.BORROW_PARTITION_MONTHS_AHEAD + 1))
+    for month in sorted(months):
+        op.execute(create_partition_sql(month))
+
+    op.execute(
+        f'INSERT INTO borrow ({COLUMNS}) '
+        f'SELECT id, book_id, borrower_name, coalesce(borrow_date, {MISSING_BORROW_DATE}), return_date '
+        'FROM borrow_unpartitioned'
+    )
+    op.execute('DROP TABLE borrow_unpartitioned')
+
+    # Индекс на секционированной таблице создаётся в каждой секции, в том числе
+    # в будущих
+    for name, definition in INDEXES:
+        op.execute(f'CREATE INDEX {name} ON {definition}')
+    op.execute('ANALYZE borrow')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('LOCK TABLE borrow IN ACCESS EXCLUSIVE MODE')
+    op.execute('ALTER TABLE borrow RENAME TO borrow_partitioned')
+    op.execute('ALTER TABLE borrow_partitioned RENAME CONSTRAINT borrow_pkey TO borrow_partitioned_pkey')
+    for name, _ in INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+
+    op.execute(
+        'CREATE TABLE borrow ('
+        "id integer NOT NULL DEFAULT nextval('borrow_id_seq') PRIMARY KEY, "
+        'book_id integer NOT NULL REFERENCES book (id), '
+        'borrower_name varchar NOT NULL, '
+        'borrow_date timestamp, '
+        'return_date timestamp'
+        ')'
+    )
+    op.execute('ALTER SEQUENCE borrow_id_seq OWNED BY borrow.id')
+    op.execute(
+        f'INSERT INTO borrow ({COLUMNS}) '
+        f'SELECT id, book_id, borrower_name, nullif(borrow_date, {MISSING_BORROW_DATE}), return_date '
+        'FROM borrow_partitioned'
+    )
+    # Секции удаляются вместе с родительской таблицей
+    op.execute('DROP TABLE borrow_partitioned')
+    for name, definition in INDEXES:
+        op.execute(f'CREATE INDEX {name} ON {definition}')
@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from config import settings
+from database import IS_POSTGRES, BorrowArchiveOrm, BorrowOrm, engine
+
+ARCHIVE_COLUMNS = ('id', 'book_id', 'borrower_name', 'borrow_date', 'return_date')
+
+
+class ArchiveProgress:
+    # Метрики текущего (или последнего) прогона переноса: GET /archive/stats и
+    # вывод python archive.py. last_id -- граница, с которой прогон можно продолжить
+    def __init__(self, timer: Callable[[], float] = time.monotonic):
+        self._timer = timer
+        self.runs = 0
+        self.total_moved = 0
+        self.running = False
+        self.cutoff: datetime | None = None
+        self.last_id = 0
+        self.batches = 0
+        self.moved = 0
+        self.error: str | None = None
+        self._started = 0.0
+        self._finished = 0.0
+
+    def start(self, cutoff: datetime, after_id: int) -> None:
+        self.runs += 1
+        self.running = True
+        self.cutoff = cutoff
+        self.last_id = after_id
+        self.batches = 0
+        self.moved = 0
+        self.error = None
+        self._started = self._finished = self._timer()
+
+    def record(self, ids: list[int]) -> None:
+        self.batches += 1
+        self.moved += len(ids)
+        self.total_moved += len(ids)
+        self.last_id = max(ids)
+        self._finished = self._timer()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.running = False
+        self.error = str(error) if error is not None else None
+        self._finished = self._timer()
+
+    def stats(self) -> dict:
+        elapsed = (self._timer() if self.running else self._finished) - self._started
+        return {
+            'running': self.running,
+            'runs': self.runs,
+            'cutoff': self.cutoff.isoformat() if self.cutoff else None,
+            'last_id': self.last_id,
+            'batches': self.batches,
+            'moved': self.moved,
+            'total_moved': self.total_moved,
+            'elapsed': round(elapsed, 3),
+            'rows_per_second': round(self.moved / elapsed, 1) if elapsed > 0 else 0.0,
+            'error': self.error,
+        }
+
+
+archive_progress = ArchiveProgress()
+
+
+def archive_cutoff(days: int) -> datetime:
+    return datetime.now() - timedelta(days=days)
+
+
+def expired_borrows_query(cutoff: datetime, after_id: int, batch_size: int):
+    # borrow_date < cutoff следует из return_date < cutoff, но это условие по ключу
+    # секционирования: свежие секции не читаются. Keyset по id: каждая пачка
+    # продолжает с места предыдущей, а не пересматривает открытые выдачи заново
+    return (select(BorrowOrm.id)
+            .where(BorrowOrm.return_date < cutoff, BorrowOrm.borrow_date < cutoff, BorrowOrm.id > after_id)
+            .order_by(BorrowOrm.id)
+            .limit(batch_size))
+
+
+async def archive_batch(connection: AsyncConnection, cutoff: datetime, after_id: int, batch_size: int) -> list[int]:
+    candidates = expired_borrows_query(cutoff, after_id, batch_size)
+    columns = [BorrowOrm.__table__.c[name] for name in ARCHIVE_COLUMNS]
+    statement = delete(BorrowOrm).where(BorrowOrm.borrow_date < cutoff)
+
+    if IS_POSTGRES:
+        # Один запрос: DELETE ... RETURNING в CTE, его строки сразу вставляются в
+        # архив. SKIP LOCKED: параллельный прогон берёт другие строки
+        moved = (statement
+                 .where(BorrowOrm.id.in_(candidates.with_for_update(skip_locked=True).scalar_subquery()))
+                 .returning(*columns)
+                 .cte('moved'))
+        result = await connection.execute(
+            insert(BorrowArchiveOrm)
+            .from_select(ARCHIVE_COLUMNS, select(*(moved.c[name] for name in ARCHIVE_COLUMNS)))
+            .returning(BorrowArchiveOrm.id)
+        )
+        return list(result.scalars())
+
+    # SQLite не поддерживает изменяющие CTE: те же два шага в одной транзакции
+    result = await connection.execute(
+        statement.where(BorrowOrm.id.in_(candidates.scalar_subquery())).returning(*columns)
+    )
+    rows = [row._asdict() for row in result]
+    if rows:
+        await connection.execute(insert(BorrowArchiveOrm), rows)
+    return [row['id'] for row in rows]
+
+
+async def archive_returned_borrows(cutoff: datetime, batch_size: int, pause: float = 0.0, after_id: int = 0,
+                                   max_batches: int | None = None,
+                                   on_batch: Callable[[dict], None] | None = None,
+                                   progress: ArchiveProgress = archive_progress) -> dict:
+    # Каждая пачка -- своя транзакция: прерванный прогон теряет не больше одной
+    # пачки, и её строки остаются в borrow. Повторный запуск продолжает с last_id
+    progress.start(cutoff, after_id)
+    try:
+        while max_batches is None or progress.batches < max_batches:
+            async with engine.begin() as connection:
+                ids = await archive_batch(connection, cutoff, progress.last_id, batch_size)
+            if not ids:
+                break
+            progress.record(ids)
+            if on_batch is not None:
+                on_batch(progress.stats())
+            await asyncio.sleep(pause)
+    except BaseException as e:
+        progress.finish(e)
+        raise
+    progress.finish()
+    return progress.stats()
+
+
+async def archive_periodically(interval: float) -> None:
+    while True:
+        try:
+            await archive_returned_borrows(archive_cutoff(settings.ARCHIVE_AFTER_DAYS),
+                                           settings.ARCHIVE_BATCH_SIZE, settings.ARCHIVE_BATCH_PAUSE)
+        except (DBAPIError, OSError) as e:
+            print(f"Перенос выдач в архив прерван: {e}")
+        await asyncio.sleep(interval)
+
+
+def print_batch(stats: dict) -> None:
+    print(f"Пачка {stats['batches']}: перенесено {stats['moved']}, последний id {stats['last_id']}, "
+          f"{stats['rows_per_second']} строк/с")
+
+
+async def run(args: argparse.Namespace) -> None:
+    try:
+        stats = await archive_returned_borrows(archive_cutoff(args.older_than_days), args.batch_size, args.pause,
+                                               args.after_id, args.max_batches, on_batch=print_batch)
+    finally:
+        await engine.dispose()
+    print(f"Готово: перенесено {stats['moved']} выдач за {stats['elapsed']} с, последний id {stats['last_id']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перенос давно закрытых выдач в borrow_archive')
+    parser.add_argument('--older-than-days', type=int, default=settings.ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--batch-size', type=int, default=settings.ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--pause', type=float, default=settings.ARCHIVE_BATCH_PAUSE)
+    parser.add_argument('--after-id', type=int, default=0, help='продолжить после выдачи с этим id')
+    parser.add_argument('--max-batches', type=int, default=None)
+    asyncio.run(run(parser.parse_args()))
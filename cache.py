@@ -0,0 +1,172 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable
+
+import orjson
+
+from config import settings
+from utils import dumps
+
+
+class TTLCache:
+    # Ограниченный по размеру LRU-кэш в памяти процесса с временем жизни записей
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at <= self._timer():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (self._timer() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def evict_if(self, predicate: Callable[[Any], bool]) -> None:
+        for key in [key for key, (_, value) in self._data.items() if predicate(value)]:
+            del self._data[key]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class MemoryCache:
+    # Бэкенд по умолчанию: TTLCache в памяти процесса. Теги хранятся рядом со
+    # значением, сброс по тегу просматривает кэш (он ограничен maxsize)
+    def __init__(self, maxsize: int, ttl: float):
+        self._entries = TTLCache(maxsize, ttl)
+
+    async def get_many(self, keys: list[str]) -> list[Any]:
+        values = []
+        for key in keys:
+            entry = self._entries.get(key)
+            values.append(entry[1] if entry is not None else None)
+        return values
+
+    async def set_many(self, items: dict[str, tuple[Any, Iterable[str]]]) -> None:
+        for key, (value, tags) in items.items():
+            self._entries.set(key, (frozenset(tags), value))
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._entries.delete(key)
+
+    async def invalidate_tags(self, *tags: str) -> None:
+        tags = set(tags)
+        self._entries.evict_if(lambda entry: not entry[0].isdisjoint(tags))
+
+    def stats(self) -> dict:
+        return {'backend': 'memory', **self._entries.stats()}
+
+
+class RedisCache:
+    # Общий кэш для нескольких воркеров и хостов: любой сервер с протоколом Redis.
+    # Значения -- JSON, тег -- множество ключей, которые он покрывает
+    def __init__(self, client, ttl: float, prefix: str = 'library:'):
+        self._redis = client
+        # Redis принимает только целое число секунд, не меньше 1: дробный TTL
+        # округляется вверх, иначе 0.5 превратился бы в отвергаемый ex=0
+        self.ttl = max(1, math.ceil(ttl))
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float) -> "RedisCache":
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError("Для CACHE_BACKEND=redis нужен пакет redis.")
+        return cls(redis.from_url(url), ttl)
+
+    def _tag_key(self, tag: str) -> str:
+        return f'{self.prefix}tag:{tag}'
+
+    async def get_many(self, keys: list[str]) -> list[Any]:
+        if not keys:
+            return []
+        # Один MGET на всю страницу вместо запроса на каждый ключ
+        raw_values = await self._redis.mget([self.prefix + key for key in keys])
+        values = []
+        for raw in raw_values:
+            if raw is None:
+                self.misses += 1
+                values.append(None)
+            else:
+                self.hits += 1
+                values.append(orjson.loads(raw))
+        return values
+
+    async def set_many(self, items: dict[str, tuple[Any, Iterable[str]]]) -> None:
+        if not items:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, (value, tags) in items.items():
+                pipe.set(self.prefix + key, dumps(value), ex=self.ttl)
+                for tag in tags:
+                    pipe.sadd(self._tag_key(tag), self.prefix + key)
+                    pipe.expire(self._tag_key(tag), self.ttl)
+            await pipe.execute()
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self._redis.delete(*(self.prefix + key for key in keys))
+
+    async def invalidate_tags(self, *tags: str) -> None:
+        if not tags:
+            return
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for tag_key in tag_keys:
+                pipe.smembers(tag_key)
+            members = await pipe.execute()
+        keys = set().union(*members)
+        await self._redis.delete(*keys, *tag_keys)
+
+    def stats(self) -> dict:
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses}
+
+
+def create_cache():
+    if settings.CACHE_BACKEND == 'redis':
+        return RedisCache.from_url(settings.CACHE_REDIS_URL, settings.CACHE_TTL)
+    return MemoryCache(settings.CACHE_MAXSIZE, settings.CACHE_TTL)
+
+
+# Карточки книг ("book:<id>") и авторов ("author:<id>"); записи в репозитории
+# сбрасывают их по ключу или по тегу автора
+cache = create_cache()
@@ -1,6 +1,16 @@
 import os
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from dotenv import load_dotenv
+from dotenv import dotenv_values, load_dotenv
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENV_FILE = os.path.join(BASE_DIR, ".env")
+
+# Профиль окружения: APP_ENV=prod дополнительно читает .env.prod, значения
+# которого перекрывают общий .env
+APP_ENV = os.getenv("APP_ENV") or dotenv_values(ENV_FILE).get("APP_ENV")
+ENV_FILES = (ENV_FILE, os.path.join(BASE_DIR, f".env.{APP_ENV}")) if APP_ENV else (ENV_FILE,)
 
 class Settings(BaseSettings):
     DB_USER: str
@@ -8,14 +18,88 @@ class Settings(BaseSettings):
     DB_HOST: str
     DB_PORT: int
     DB_NAME: str
+    # Полный URL базы вместо DB_*, например sqlite+aiosqlite:///library.db
+    # для встроенной базы на киосках
+    DATABASE_URL: str | None = None
+
+    # Пул соединений движка Postgres. Размер пула -- на один процесс: при N воркерах
+    # к базе открывается до N * (DB_POOL_SIZE + DB_MAX_OVERFLOW) соединений
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    # Сколько секунд ждать свободного соединения, прежде чем отдать ошибку
+    DB_POOL_TIMEOUT: float = 30
+    # Пересоздавать соединения старше стольких секунд (-1 -- никогда)
+    DB_POOL_RECYCLE: int = -1
+    # Проверять соединение перед выдачей из пула (лишний round trip на checkout)
+    DB_POOL_PRE_PING: bool = False
+    # Кэш подготовленных выражений asyncpg на соединение; 0 -- для pgbouncer
+    # в режиме transaction
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    # Таймаут запроса на стороне клиента asyncpg, секунды
+    DB_COMMAND_TIMEOUT: float | None = None
+    # Параметры сессии Postgres, например {"statement_timeout": "5000", "application_name": "library"}
+    DB_SERVER_SETTINGS: dict[str, str] = {}
+
+    # Реплики для чтения (URL в формате DATABASE_URL). GET-запросы распределяются
+    # по ним по кругу, запись всегда идёт на primary
+    DB_REPLICA_URLS: list[str] = []
+    # На сколько секунд реплика с ошибкой подключения выводится из ротации
+    DB_REPLICA_RETRY_AFTER: float = 30.0
+    # Сколько секунд чтение с X-Consistency-Token ждёт догнавшую реплику,
+    # прежде чем уйти на primary
+    DB_REPLICA_MAX_WAIT: float = 0.2
+
+    # dev: таблицы создаются при старте и удаляются при остановке (разработка и тесты).
+    # prod: схема ведётся миграциями Alembic, при старте только прогревается пул
+    STARTUP_MODE: Literal['dev', 'prod'] = 'dev'
+    # Сколько соединений пула открыть и подготовить при старте в режиме prod
+    POOL_WARMUP_CONNECTIONS: int = 5
+
+    # Postgres: на сколько месяцев вперёд держать готовые секции borrow
+    BORROW_PARTITION_MONTHS_AHEAD: int = 3
+    # Как часто (в секундах) проверять в фоне, что секции созданы; None -- только
+    # отдельным заданием python partitions.py (cron). Фоновая проверка -- это DDL
+    # в каждом воркере, поэтому её включают в одном процессе, а не во всех
+    BORROW_PARTITION_CHECK_INTERVAL: float | None = None
+
+    # Закрытые выдачи, возвращённые раньше чем столько дней назад, переносятся
+    # в borrow_archive (archive.py)
+    ARCHIVE_AFTER_DAYS: int = 365
+    # Сколько выдач переносится одной транзакцией
+    ARCHIVE_BATCH_SIZE: int = 1000
+    # Пауза между пачками (в секундах), чтобы перенос не занимал базу целиком
+    ARCHIVE_BATCH_PAUSE: float = 0.1
+    # Как часто (в секундах) запускать перенос в фоне; None -- только вручную
+    # через python archive.py
+    ARCHIVE_INTERVAL: float | None = None
+
+    # Сколько строк читается из серверного курсора за раз при выгрузке каталога
+    EXPORT_CHUNK_SIZE: int = 1000
+    # Сколько записей массового импорта пишется одним upsert-запросом
+    IMPORT_BATCH_SIZE: int = 1000
+
+    # Кэш карточек книг и авторов: "memory" -- в памяти процесса,
+    # "redis" -- общий для всех воркеров сервер по CACHE_REDIS_URL
+    CACHE_BACKEND: Literal['memory', 'redis'] = 'memory'
+    CACHE_REDIS_URL: str = 'redis://localhost:6379/0'
+    CACHE_MAXSIZE: int = 10000
+    CACHE_TTL: float = 60.0
+
+    # Конфигурация полнотекстового поиска Postgres для колонки book.search_vector.
+    # Меняется только вместе с пересозданием колонки
+    SEARCH_CONFIG: str = 'simple'
+    # Минимальное сходство (pg_trgm similarity) для нечёткого поиска авторов
+    AUTHOR_SEARCH_THRESHOLD: float = 0.3
 
-    model_config = SettingsConfigDict(
-        env_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
-    )
+    model_config = SettingsConfigDict(env_file=ENV_FILES)
 
     def get_db_url(self):
+        if self.DATABASE_URL:
+            return self.DATABASE_URL
         return (f"postgresql+asyncpg://{self.DB_USER}:{self.DB_PASSWORD}@"
                 f"{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}")
 
-load_dotenv()
+# Первый загруженный файл выигрывает: профиль читается раньше общего .env
+for env_file in reversed(ENV_FILES):
+    load_dotenv(env_file)
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,62 @@
+import os
+import tempfile
+
+# Тесты репозиториев по умолчанию идут на временном файле SQLite; чтобы
+# прогнать их на Postgres, задайте DATABASE_URL явно
+os.environ.setdefault('DATABASE_URL', f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'library.db')}")
+
+import pytest
+import pytest_asyncio
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def timer():
+    return FakeTimer()
+
+
+@pytest_asyncio.fixture
+async def session(monkeypatch):
+    # Чистая схема, пустой кэш и пустой поисковый индекс на каждый тест
+    import repository
+    from cache import MemoryCache
+    from database import create_tables, delete_tables, engine, new_session
+    from search_index import book_index
+
+    monkeypatch.setattr(repository, 'cache', MemoryCache(maxsize=100, ttl=60))
+    book_index.clear()
+    await delete_tables()
+    await create_tables()
+    async with new_session() as session:
+        yield session
+    await engine.dispose()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Приложение целиком, с lifespan. TestClient работает в своём цикле событий:
+    # схема пересоздаётся в нём же, и lifespan закрывает пулы там, где соединения
+    # открывались
+    import repository
+    from cache import MemoryCache
+    from database import create_tables, delete_tables
+    from fastapi.testclient import TestClient
+    from main import app
+    from search_index import book_index
+
+    async def reset():
+        await delete_tables()
+        await create_tables()
+        book_index.clear()
+
+    monkeypatch.setattr(repository, 'cache', MemoryCache(maxsize=100, ttl=60))
+    with TestClient(app) as client:
+        client.portal.call(reset)
+        yield client
@@ -1,18 +1,212 @@
+import asyncio
+import itertools
+import re
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, date
-from typing import Annotated, Optional
+from typing import Annotated, AsyncIterator, Optional
 
-from sqlalchemy import ForeignKey, func
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from fastapi import Header, Response
+from sqlalchemy import DDL, ForeignKey, Index, event, func, literal_column, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Mapped, relationship, mapped_column, declarative_base, DeclarativeBase, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from config import settings
 from models import Author, Book, Borrow
+from partitions import DEFAULT_PARTITION_SQL
 
 DATABASE_URL = settings.get_db_url()
 
-engine = create_async_engine(url=DATABASE_URL)
+IS_POSTGRES = DATABASE_URL.startswith('postgresql')
 
-new_session = async_sessionmaker(engine, expire_on_commit=False)
+
+def engine_options() -> dict:
+    # Встроенная SQLite работает со своим пулом по умолчанию
+    if not IS_POSTGRES:
+        return {}
+    return {
+        'pool_size': settings.DB_POOL_SIZE,
+        'max_overflow': settings.DB_MAX_OVERFLOW,
+        'pool_timeout': settings.DB_POOL_TIMEOUT,
+        'pool_recycle': settings.DB_POOL_RECYCLE,
+        'pool_pre_ping': settings.DB_POOL_PRE_PING,
+        'connect_args': {
+            # Кэш asyncpg и кэш подготовленных выражений диалекта SQLAlchemy
+            # настраиваются вместе: для pgbouncer оба должны быть выключены
+            'statement_cache_size': settings.DB_STATEMENT_CACHE_SIZE,
+            'prepared_statement_cache_size': settings.DB_STATEMENT_CACHE_SIZE,
+            'command_timeout': settings.DB_COMMAND_TIMEOUT,
+            'server_settings': settings.DB_SERVER_SETTINGS,
+        },
+    }
+
+
+engine = create_async_engine(url=DATABASE_URL, **engine_options())
+
+# INSERT ... ON CONFLICT есть и в Postgres, и в SQLite, но конструкция у каждого диалекта своя
+if IS_POSTGRES:
+    from sqlalchemy.dialects.postgresql import insert
+else:
+    from sqlalchemy.dialects.sqlite import insert
+
+    @event.listens_for(engine.sync_engine, 'connect')
+    def register_sqlite_functions(dbapi_connection, connection_record):
+        # В SQLite нет btrim, а встроенный lower понимает только ASCII. Выражения
+        # уникальных индексов должны нормализовать так же, как author_identity_key.
+        # btrim с одним аргументом убирает только пробелы
+        dbapi_connection.create_function(
+            'btrim', 1, lambda value: value.strip(' ') if value is not None else None, deterministic=True)
+        dbapi_connection.create_function(
+            'lower', 1, lambda value: value.lower() if value is not None else None, deterministic=True)
+
+# Токен согласованности -- позиция WAL primary после коммита записи. Чтение с
+# этим токеном идёт только на реплику, которая проиграла WAL до этой позиции
+CONSISTENCY_HEADER = 'X-Consistency-Token'
+CONSISTENCY_TOKEN_RE = re.compile(r'[0-9A-F]{1,8}/[0-9A-F]{1,8}', re.IGNORECASE)
+CURRENT_WAL_LSN = text('SELECT pg_current_wal_lsn()::text')
+# На primary pg_last_wal_replay_lsn() -- NULL, он всегда "догнал" сам себя
+REPLICA_CAUGHT_UP = text('SELECT coalesce(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) >= CAST(CAST(:token AS text) AS pg_lsn)')
+REPLICA_POLL_INTERVAL = 0.02
+
+
+class LibrarySession(AsyncSession):
+    # Запись коммитится внутри репозитория, поэтому токен снимается здесь же:
+    # заголовок попадает в ответ, пока обработчик ещё не вернул результат
+    async def commit(self) -> None:
+        await super().commit()
+        if IS_POSTGRES and replica_engines:
+            token = await self.scalar(CURRENT_WAL_LSN)
+            self.info[CONSISTENCY_HEADER] = token
+            response = self.info.get('response')
+            if response is not None:
+                response.headers[CONSISTENCY_HEADER] = token
+
+
+new_session = async_sessionmaker(engine, class_=LibrarySession, expire_on_commit=False)
+
+
+async def get_session(response: Response) -> AsyncIterator[AsyncSession]:
+    # Одна сессия (и одно соединение из пула) на весь запрос
+    async with new_session() as session:
+        session.info['response'] = response
+        yield session
+
+
+def consistency_headers(session: AsyncSession) -> dict:
+    # Для обработчиков, которые сами собирают Response
+    token = session.info.get(CONSISTENCY_HEADER)
+    return {CONSISTENCY_HEADER: token} if token else {}
+
+
+class ReplicaRouter:
+    # Выбор реплики по кругу. Реплика, на которой оборвалось соединение, выводится
+    # из ротации на retry_after секунд, затем снова получает запросы. Если живых
+    # реплик нет, choose() возвращает None и чтение идёт на primary
+    def __init__(self, engines: list, retry_after: float, timer=time.monotonic):
+        self.engines = engines
+        self.retry_after = retry_after
+        self._timer = timer
+        self._down_until: dict[int, float] = {}
+        self._next = itertools.cycle(range(len(engines)))
+
+    def choose(self):
+        now = self._timer()
+        for _ in range(len(self.engines)):
+            index = next(self._next)
+            if self._down_until.get(index, 0.0) <= now:
+                self._down_until.pop(index, None)
+                return self.engines[index]
+        return None
+
+    def mark_down(self, engine) -> None:
+        self._down_until[self.engines.index(engine)] = self._timer() + self.retry_after
+
+    def healthy(self) -> list:
+        now = self._timer()
+        return [engine for index, engine in enumerate(self.engines) if self._down_until.get(index, 0.0) <= now]
+
+
+replica_engines = [create_async_engine(url=url, **engine_options()) for url in settings.DB_REPLICA_URLS]
+replicas = ReplicaRouter(replica_engines, settings.DB_REPLICA_RETRY_AFTER)
+
+
+def is_disconnect(error: BaseException) -> bool:
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, (OperationalError, InterfaceError, OSError))
+
+
+# Флаги сессии для кэша карточек (repository.py). Запрос с токеном согласованности
+# кэш не читает: карточка в нём может быть старше записи клиента. Сессии реплик
+# кэш не заполняют: отставшая реплика вернула бы в него карточку, которую запись
+# на primary только что сбросила
+CACHE_READ = 'cache_read'
+CACHE_FILL = 'cache_fill'
+
+
+def new_read_session() -> AsyncSession:
+    # Сессия для чтения: реплика по кругу или primary, если реплик нет
+    replica = replicas.choose()
+    if replica is None:
+        return new_session()
+    return new_session(bind=replica, info={CACHE_FILL: False})
+
+
+async def caught_up_session(token: str) -> AsyncSession | None:
+    # Обходит живые реплики по разу; соединение проверенной реплики остаётся
+    # за сессией, так что запрос читает именно с неё
+    for _ in range(len(replicas.engines)):
+        replica = replicas.choose()
+        if replica is None:
+            return None
+        session = new_session(bind=replica, info={CACHE_READ: False, CACHE_FILL: False})
+        try:
+            if await session.scalar(REPLICA_CAUGHT_UP, {'token': token}):
+                return session
+        except BaseException as error:
+            await session.close()
+            if not is_disconnect(error):
+                raise
+            replicas.mark_down(replica)
+            continue
+        await session.close()
+    return None
+
+
+async def new_consistent_read_session(token: str | None) -> AsyncSession:
+    if token is None:
+        return new_read_session()
+    if not IS_POSTGRES or not replicas.engines or not CONSISTENCY_TOKEN_RE.fullmatch(token):
+        # Реплик нет или токен непонятный (проверить реплику не по чему): primary
+        return new_session(info={CACHE_READ: False})
+    deadline = time.monotonic() + settings.DB_REPLICA_MAX_WAIT
+    while True:
+        session = await caught_up_session(token)
+        if session is not None:
+            return session
+        if not replicas.healthy() or time.monotonic() >= deadline:
+            return new_session(info={CACHE_READ: False})
+        await asyncio.sleep(REPLICA_POLL_INTERVAL)
+
+
+@asynccontextmanager
+async def read_session(token: str | None) -> AsyncIterator[AsyncSession]:
+    # Обрыв соединения с репликой посреди запроса выводит её из ротации
+    async with await new_consistent_read_session(token) as session:
+        try:
+            yield session
+        except BaseException as error:
+            if session.bind is not engine and is_disconnect(error):
+                replicas.mark_down(session.bind)
+            raise
+
+
+async def get_read_session(x_consistency_token: Optional[str] = Header(None)) -> AsyncIterator[AsyncSession]:
+    async with read_session(x_consistency_token) as session:
+        yield session
 
 class Model(DeclarativeBase):
    pass
@@ -20,12 +214,20 @@ class Model(DeclarativeBase):
 
 class AuthorOrm(Model):
     __tablename__ = 'author'
-    id: Mapped[int | None] = mapped_column(primary_key=True, autoincrement=True)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     first_name: Mapped[str | None]
     last_name: Mapped[str | None]
     birth_date: Mapped[datetime | None]
+    # Версия строки: увеличивается при каждой записи, из неё строится ETag
+    version: Mapped[int] = mapped_column(default=1, server_default='1')
 
-    book: Mapped["Book"] = relationship("BookOrm", back_populates="author", lazy='joined')
+    # ORM сам проверяет и увеличивает версию при flush: UPDATE/DELETE идут с
+    # WHERE version = :v, устаревший объект даёт StaleDataError
+    __mapper_args__ = {'version_id_col': version}
+
+    # Связи по умолчанию не загружаются: запрос репозитория сам указывает
+    # selectinload/joinedload для того, что попадёт в ответ
+    book: Mapped["Book"] = relationship("BookOrm", back_populates="author", lazy='raise')
     # borrows: Mapped["Borrow"] = relationship("BorrowOrm", back_populates="author", foreign_keys="[BorrowOrm.author_id]", lazy='joined')
 
     def model_dump(self):
@@ -35,35 +237,113 @@ class AuthorOrm(Model):
             'birth_date': self.birth_date.strftime('%Y-%m-%d') if self.birth_date else None
         }
 
+# Нормализованный ключ автора: регистр и пробелы не различаются, NULL приводится
+# к константе, чтобы уникальный индекс срабатывал и для неполных данных
+AUTHOR_IDENTITY = (
+    func.lower(func.btrim(func.coalesce(AuthorOrm.first_name, literal_column("''")))),
+    func.lower(func.btrim(func.coalesce(AuthorOrm.last_name, literal_column("''")))),
+    func.coalesce(AuthorOrm.birth_date, literal_column("'0001-01-01'")),
+)
+
+Index('uq_author_identity', *AUTHOR_IDENTITY, unique=True)
+
+
+# Нормализованное полное имя для нечёткого поиска. Выражение должно совпадать
+# с выражением индекса ix_author_full_name_trgm, иначе индекс не используется
+AUTHOR_FULL_NAME = func.lower(func.btrim(
+    func.coalesce(AuthorOrm.first_name, literal_column("''")).op('||')(literal_column("' '"))
+    .op('||')(func.coalesce(AuthorOrm.last_name, literal_column("''")))
+))
+
+# Триграммный GIN-индекс создаётся, только если в кластере есть расширение pg_trgm
+event.listen(AuthorOrm.__table__, 'after_create', DDL(
+    "DO $$ BEGIN "
+    "IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN "
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm; "
+    "CREATE INDEX ix_author_full_name_trgm ON author USING gin "
+    "((lower(btrim(coalesce(first_name, '') || ' ' || coalesce(last_name, '')))) gin_trgm_ops); "
+    "END IF; "
+    "END $$"
+).execute_if(dialect='postgresql'))
+
+
+def author_identity_key(first_name: str | None, last_name: str | None, birth_date: date | None) -> tuple:
+    # То же правило нормализации, что и в AUTHOR_IDENTITY, но на стороне Python.
+    # strip(' '), а не strip(): btrim не трогает табуляции и неразрывные пробелы
+    if birth_date is None:
+        birth_date = datetime(1, 1, 1)
+    elif not isinstance(birth_date, datetime):
+        birth_date = datetime(birth_date.year, birth_date.month, birth_date.day)
+    return (
+        (first_name or '').strip(' ').lower(),
+        (last_name or '').strip(' ').lower(),
+        birth_date,
+    )
+
 class BookOrm(Model):
     __tablename__ = 'book'
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     title: Mapped[str]
     description: Mapped[str | None]
     available_copies: Mapped[int]
-    author_id: Mapped[Optional[int]] = mapped_column(ForeignKey('author.id'), nullable=True)
+    author_id: Mapped[Optional[int]] = mapped_column(ForeignKey('author.id'), nullable=True, index=True)
+    version: Mapped[int] = mapped_column(default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
-    borrows: Mapped["Borrow"] = relationship("BorrowOrm", back_populates="book", foreign_keys="[BorrowOrm.book_id]", lazy='joined')
-    author: Mapped[Optional["AuthorOrm"]] = relationship("AuthorOrm", back_populates="book", lazy='joined')
+    borrows: Mapped["Borrow"] = relationship("BorrowOrm", back_populates="book", foreign_keys="[BorrowOrm.book_id]", lazy='raise')
+    author: Mapped[Optional["AuthorOrm"]] = relationship("AuthorOrm", back_populates="book", lazy='raise')
 
     def model_dump(self):
         return {
             'title': self.title,
             'description': self.description,
-            'author': self.author_id if self.author else None,
+            'author': self.author_id,
             'available_copies': self.available_copies,
         }
 
+# Один экземпляр книги: автор и нормализованное название. Повторное добавление
+# увеличивает available_copies вместо новой строки
+BOOK_IDENTITY = (
+    func.coalesce(BookOrm.author_id, literal_column('0')),
+    func.lower(func.btrim(BookOrm.title)),
+)
+
+Index('uq_book_identity', *BOOK_IDENTITY, unique=True)
+# Keyset-пагинация списка книг по названию
+Index('ix_book_title_id', BookOrm.title, BookOrm.id)
+
+# Полнотекстовый поиск (только Postgres): генерируемая колонка tsvector по названию
+# (вес A) и описанию (вес B) с GIN-индексом. В ORM она не отображается, чтобы
+# обычные чтения книги её не загружали; запросы обращаются к ней через BOOK_SEARCH_VECTOR
+BOOK_SEARCH_VECTOR = literal_column('book.search_vector', TSVECTOR)
+
+event.listen(BookOrm.__table__, 'after_create', DDL(
+    "ALTER TABLE book ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    f"setweight(to_tsvector('{settings.SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+    f"setweight(to_tsvector('{settings.SEARCH_CONFIG}', coalesce(description, '')), 'B')"
+    ") STORED"
+).execute_if(dialect='postgresql'))
+event.listen(BookOrm.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_book_search_vector ON book USING gin (search_vector)"
+).execute_if(dialect='postgresql'))
+
 class BorrowOrm(Model):
     __tablename__ = 'borrow'
-    id: Mapped[int] = mapped_column(primary_key=True)
-    book_id: Mapped[int] = mapped_column(ForeignKey('book.id'))
+    # В Postgres выдачи секционированы по месяцам borrow_date (partitions.py).
+    # Ключ секционирования обязан входить в первичный ключ таблицы, но ORM
+    # по-прежнему узнаёт выдачу по одному id
+    __table_args__ = {'postgresql_partition_by': 'RANGE (borrow_date)'}
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    book_id: Mapped[int] = mapped_column(ForeignKey('book.id'), index=True)
     # author_id: Mapped[int] = mapped_column(ForeignKey('author.id'))
     borrower_name: Mapped[str]
-    borrow_date: Mapped[datetime | None]
+    borrow_date: Mapped[datetime | None] = mapped_column(primary_key=IS_POSTGRES, nullable=not IS_POSTGRES)
     return_date: Mapped[datetime | None]
 
-    book: Mapped["BookOrm"] = relationship("BookOrm", back_populates="borrows", lazy='joined')
+    __mapper_args__ = {'primary_key': [id]}
+
+    book: Mapped["BookOrm"] = relationship("BookOrm", back_populates="borrows", lazy='raise')
     # author: Mapped["AuthorOrm"] = relationship("AuthorOrm", back_populates="borrows", lazy='joined')
 
     def model_dump(self):
@@ -73,6 +353,59 @@ class BorrowOrm(Model):
             'borrow_date': self.borrow_date,
         }
 
+# Открытые выдачи книги: закрытые, которых большинство, в индекс не попадают
+Index('ix_borrow_open_book_id', BorrowOrm.book_id,
+      postgresql_where=BorrowOrm.return_date.is_(None), sqlite_where=BorrowOrm.return_date.is_(None))
+# Месячные секции создаёт фоновая задача, секция по умолчанию нужна сразу
+event.listen(BorrowOrm.__table__, 'after_create', DDL(DEFAULT_PARTITION_SQL).execute_if(dialect='postgresql'))
+
+class BorrowArchiveOrm(Model):
+    # Давно закрытые выдачи (archive.py): нужны только отчётам и не раздувают
+    # borrow и его индексы. Без внешнего ключа: архив переживает удаление книги
+    __tablename__ = 'borrow_archive'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    book_id: Mapped[int]
+    borrower_name: Mapped[str]
+    borrow_date: Mapped[datetime | None]
+    return_date: Mapped[datetime | None]
+    archived_at: Mapped[datetime] = mapped_column(server_default=func.now())
+
+async def warm_up_pool(engine: AsyncEngine, connections: int, statements: list) -> None:
+    # Соединения открываются одновременно, иначе пул раз за разом отдавал бы одно
+    # и то же. На каждом выполняются горячие запросы: asyncpg готовит их и держит
+    # в кэше подготовленных выражений соединения. Больше, чем вмещает пул, не
+    # открыть: лишние соединения ждали бы pool_timeout и падали с ошибкой
+    pool = engine.pool
+    if isinstance(pool, QueuePool) and pool._max_overflow >= 0:
+        connections = min(connections, pool.size() + pool._max_overflow)
+    results = await asyncio.gather(*(engine.connect().start() for _ in range(connections)), return_exceptions=True)
+    opened = [result for result in results if not isinstance(result, BaseException)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    try:
+        if errors:
+            raise errors[0]
+        async def prime(connection):
+            for statement in statements:
+                await connection.execute(statement)
+            await connection.rollback()
+
+        await asyncio.gather(*(prime(connection) for connection in opened))
+    finally:
+        # close() возвращает соединение в пул, а не закрывает его
+        for connection in opened:
+            await connection.close()
+
+async def warm_up_replicas(router: ReplicaRouter, connections: int, statements: list) -> None:
+    # Недоступная при старте реплика не мешает запуску: она выводится из
+    # ротации, как при обрыве соединения во время чтения, и чтения идут на
+    # остальные реплики или primary
+    for replica in router.engines:
+        try:
+            await warm_up_pool(replica, connections, statements)
+        except (DBAPIError, OSError) as e:
+            print(f"Не удалось прогреть реплику {replica.url}: {e}")
+            router.mark_down(replica)
+
 async def create_tables():
     async with engine.begin() as connection:
         await connection.run_sync(Model.metadata.create_all)
@@ -1,63 +1,176 @@
+import asyncio
 from contextlib import asynccontextmanager
 from datetime import date
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Header, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.params import Depends
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy.testing import exclude
 
-from database import create_tables, delete_tables, BookOrm
+from archive import archive_periodically, archive_progress
+from cache import cache
+from config import settings
+from database import create_tables, delete_tables, engine, get_read_session, get_session, new_session, read_session
+from database import IS_POSTGRES, consistency_headers, replica_engines, replicas, warm_up_pool, warm_up_replicas, BookOrm
 from models import Author, Book, Borrow, SchemaAuthor, SchemaBook, SchemaBarrow
-from repository import AuthorRepository, BookRepository, BorrowRepository
+from partitions import maintain_borrow_partitions
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursorError, decode_cursor, paginate
+from repository import AuthorRepository, BookRepository, BorrowRepository, BookBorrowedError, BookNotFoundError, BookNotAvailableError
+from repository import USE_SEARCH_INDEX, DuplicateError, SearchUnavailableError, VersionConflictError, warmup_statements
+from repository import BOOK_COLUMNS, BORROW_COLUMNS, author_etag, book_etag, borrow_etag
 from test_database import book_data
+from utils import ORJSONResponse, csv_records, csv_stream, digest_etag, etag_matches, iter_lines, ndjson_records, ndjson_stream
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await create_tables()
+    if settings.STARTUP_MODE == "dev":
+        await create_tables()
+    else:
+        # В prod схему ведут миграции: DDL при старте брал бы блокировки, пока
+        # соседние воркеры обслуживают запросы
+        await warm_up_pool(engine, settings.POOL_WARMUP_CONNECTIONS, warmup_statements())
+        await warm_up_replicas(replicas, settings.POOL_WARMUP_CONNECTIONS, warmup_statements())
+    if USE_SEARCH_INDEX:
+        async with new_session() as session:
+            await BookRepository.build_search_index(session, settings.EXPORT_CHUNK_SIZE)
+    # Месячные секции borrow создаются заранее, пока в них ещё нет строк, если
+    # эта задача включена для процесса
+    partitions_task = None
+    if IS_POSTGRES and settings.BORROW_PARTITION_CHECK_INTERVAL:
+        partitions_task = asyncio.create_task(maintain_borrow_partitions(
+            engine, settings.BORROW_PARTITION_MONTHS_AHEAD, settings.BORROW_PARTITION_CHECK_INTERVAL))
+    # Перенос давно закрытых выдач в архив, если он включён
+    archive_task = None
+    if settings.ARCHIVE_INTERVAL:
+        archive_task = asyncio.create_task(archive_periodically(settings.ARCHIVE_INTERVAL))
     print("База готова")
     yield
-    await delete_tables()
-    print("База очищена")
+    for task in (partitions_task, archive_task):
+        if task is not None:
+            task.cancel()
+    if settings.STARTUP_MODE == "dev":
+        await delete_tables()
+        print("База очищена")
+    for pool_engine in [engine, *replica_engines]:
+        await pool_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+@app.exception_handler(InvalidCursorError)
+async def invalid_cursor_handler(request: Request, exc: InvalidCursorError):
+    return ORJSONResponse(status_code=400, content={"detail": str(exc)})
+
+
+def not_modified(if_none_match: str | None, etag: str | None) -> Response | None:
+    if if_none_match is None or etag is None or not etag_matches(if_none_match, etag):
+        return None
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def etag_response(content, etag: str, if_none_match: str | None = None, headers: dict | None = None) -> Response:
+    # Совпавший ETag отвечает 304 без тела: сериализация пропускается
+    headers = {"ETag": etag, **(headers or {})}
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(content, headers=headers)
+
+
+def if_match_etag(if_match: str | None) -> str | None:
+    # If-Match: * означает "любая версия", то есть запись без проверки
+    if if_match is None or if_match.strip() == "*":
+        return None
+    return if_match
+
+
+def page_response(items: list, next_cursor: str | None, etag_of, if_none_match: str | None = None) -> Response:
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    etag = digest_etag([etag_of(item) for item in items])
+    return etag_response(items, etag, if_none_match, headers)
 
 
-app = FastAPI(lifespan=lifespan)
+def export_response(stream_rows, columns, format: str, token: Optional[str]) -> StreamingResponse:
+    # Своя сессия внутри генератора: она должна жить, пока отдаётся тело ответа,
+    # а не только до выхода из обработчика. Токен согласованности учитывается
+    # так же, как в get_read_session
+    async def partitions():
+        async with read_session(token) as session:
+            async for rows in stream_rows(session, settings.EXPORT_CHUNK_SIZE):
+                yield rows
+
+    if format == "csv":
+        fieldnames = [column.key for column in columns]
+        return StreamingResponse(csv_stream(partitions(), fieldnames), media_type="text/csv")
+    return StreamingResponse(ndjson_stream(partitions()), media_type="application/x-ndjson")
 
 
 # Эндпоинтs для авторов
 @app.post("/")
-async def create_author(author: Author = Depends()):
+async def create_author(author: Author = Depends(), session: AsyncSession = Depends(get_session)):
     author_repository = AuthorRepository()
-    created_author = await author_repository.create_author(author)
+    created_author = await author_repository.create_author(session, author)
     return {"message": "Автор успешно добавлен в библиотеку!", "author": created_author}
 
 
-@app.get("/authors", response_model=List[Author])
-async def get_authors():
-    authors = await AuthorRepository.get_authors()
-    return authors
-
-
-@app.get("/authors/{id}", response_model=Author)
-async def get_author_by_id(author_id: int):
-    author = await AuthorRepository.get_author_by_id(author_id)
+@app.get("/authors", response_model=List[SchemaAuthor])
+async def get_authors(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                      after: Optional[str] = None,
+                      if_none_match: Optional[str] = Header(None),
+                      session: AsyncSession = Depends(get_read_session)):
+    authors = await AuthorRepository.get_authors(session, limit + 1, decode_cursor(after, 'id'))
+    return page_response(*paginate(authors, limit, 'id'), author_etag, if_none_match)
+
+
+@app.get("/authors/search", response_model=List[SchemaAuthor])
+async def search_authors(q: str = Query(min_length=1),
+                         threshold: float = Query(settings.AUTHOR_SEARCH_THRESHOLD, ge=0, le=1),
+                         limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         after: Optional[str] = None,
+                         session: AsyncSession = Depends(get_read_session)):
+    try:
+        authors = await AuthorRepository.search_authors(session, q, limit + 1, threshold, decode_cursor(after, 'similarity'))
+    except SearchUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return page_response(*paginate(authors, limit, 'similarity'), author_etag)
+
+
+@app.get("/authors/{id}", response_model=SchemaAuthor)
+async def get_author_by_id(author_id: int,
+                           if_none_match: Optional[str] = Header(None),
+                           session: AsyncSession = Depends(get_read_session)):
+    if if_none_match is not None:
+        response = not_modified(if_none_match, await AuthorRepository.get_author_etag(session, author_id))
+        if response:
+            return response
+    author = await AuthorRepository.get_author_by_id(session, author_id)
     if author:
-        return author
-    return {"error": "Author not found"}
+        return etag_response(author, author_etag(author))
+    raise HTTPException(status_code=404, detail="Author not found")
 
 
 @app.put("/authors/{id}", response_model=Author)
-async def update_author(id: int, author: Author):
-    updated_author = await AuthorRepository.update_author(id, author.model_dump())
+async def update_author(id: int, author: Author,
+                        if_match: Optional[str] = Header(None),
+                        session: AsyncSession = Depends(get_session)):
+    try:
+        updated_author = await AuthorRepository.update_author(session, id, author.model_dump(), if_match_etag(if_match))
+    except VersionConflictError as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except DuplicateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if updated_author:
-        return updated_author
+        return etag_response(updated_author, author_etag(updated_author), headers=consistency_headers(session))
     return {"error": "Author not found"}
 
 
 @app.delete("/authors/{id}", response_model=SchemaAuthor)
-async def delete_author(id: int):
-    deleted_author = await AuthorRepository.delete_author(id)
+async def delete_author(id: int, session: AsyncSession = Depends(get_session)):
+    deleted_author = await AuthorRepository.delete_author(session, id)
     if deleted_author:
         return deleted_author
     else:
@@ -67,39 +180,138 @@ async def delete_author(id: int):
 # Эндпоинты для книг
 
 @app.post("/book")
-async def create_book(book_data: Book = Depends()):
+async def create_book(book_data: Book = Depends(), session: AsyncSession = Depends(get_session)):
     book = Book(**book_data.model_dump())
     book_repository = BookRepository()
-    created_book = await book_repository.create_book(book)
+    created_book = await book_repository.create_book(session, book)
     return {"message": "Книга успешно добавлена в библиотеку!", "book": created_book}
 
 
-@app.get("/books", response_model=List[Book])
-async def get_books():
-    books = await BookRepository.get_books()
-    return books
+# Сколько ошибок по строкам возвращается в отчёте импорта
+MAX_REPORTED_ERRORS = 1000
+
+
+def book_from_record(record: dict) -> tuple[Book, int]:
+    # Запись импорта: поля Book, автор вложенным объектом "author" или плоскими
+    # полями author_* (как в выгрузке), available_copies -- число добавляемых копий
+    record = {key: value for key, value in record.items() if value not in ("", None)}
+    author = record.pop("author", None)
+    flat_author = {key[len("author_"):]: record.pop(key) for key in list(record)
+                   if key.startswith("author_") and key != "author_id"}
+    if author is None and flat_author:
+        author = flat_author
+    copies = int(record.pop("available_copies", 1))
+    if copies < 1:
+        raise ValueError("available_copies должно быть положительным.")
+    return Book(title=record.get("title"), description=record.get("description"), author=author), copies
+
+
+@app.post("/books/bulk")
+async def bulk_create_books(request: Request,
+                            format: Optional[Literal['ndjson', 'csv']] = None,
+                            session: AsyncSession = Depends(get_session)):
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    lines = iter_lines(request.stream())
+    records = csv_records(lines) if format == "csv" else ndjson_records(lines)
+
+    report = {"imported": 0, "failed": 0, "errors": []}
+
+    def add_error(line_number: int, error) -> None:
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append({"line": line_number, "error": str(error)})
+
+    async def flush(batch: list, batch_lines: list) -> None:
+        errors = await BookRepository.bulk_create_books(session, batch)
+        for line_number, (_, copies), error in zip(batch_lines, batch, errors):
+            if error:
+                add_error(line_number, error)
+            else:
+                report["imported"] += copies
+
+    batch, batch_lines = [], []
+    async for line_number, record in records:
+        if isinstance(record, Exception):
+            add_error(line_number, record)
+            continue
+        try:
+            batch.append(book_from_record(record))
+        except (ValueError, TypeError) as e:
+            add_error(line_number, e)
+            continue
+        batch_lines.append(line_number)
+        if len(batch) >= settings.IMPORT_BATCH_SIZE:
+            await flush(batch, batch_lines)
+            batch, batch_lines = [], []
+    if batch:
+        await flush(batch, batch_lines)
+    return report
+
+
+@app.get("/books", response_model=List[SchemaBook])
+async def get_books(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                    after: Optional[str] = None,
+                    order_by: Literal['id', 'title'] = 'id',
+                    if_none_match: Optional[str] = Header(None),
+                    session: AsyncSession = Depends(get_read_session)):
+    books = await BookRepository.get_books(session, limit + 1, decode_cursor(after, order_by), order_by)
+    return page_response(*paginate(books, limit, order_by), book_etag, if_none_match)
+
+
+@app.get("/books/search", response_model=List[SchemaBook])
+async def search_books(q: str = Query(min_length=1),
+                       limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                       after: Optional[str] = None,
+                       if_none_match: Optional[str] = Header(None),
+                       session: AsyncSession = Depends(get_read_session)):
+    books = await BookRepository.search_books(session, q, limit + 1, decode_cursor(after, 'rank'))
+    return page_response(*paginate(books, limit, 'rank'), book_etag, if_none_match)
+
+
+@app.get("/books/export")
+async def export_books(format: Literal['ndjson', 'csv'] = 'ndjson',
+                       x_consistency_token: Optional[str] = Header(None)):
+    return export_response(BookRepository.stream_books, BOOK_COLUMNS, format, x_consistency_token)
 
 
 @app.get("/books/{id}", response_model=SchemaBook)
-async def get_book_by_id(id: int):
-    book = await BookRepository.get_book_by_id(id)
+async def get_book_by_id(id: int,
+                         if_none_match: Optional[str] = Header(None),
+                         session: AsyncSession = Depends(get_read_session)):
+    # Проверка If-None-Match читает только версию, карточка не загружается
+    if if_none_match is not None:
+        response = not_modified(if_none_match, await BookRepository.get_book_etag(session, id))
+        if response:
+            return response
+    book = await BookRepository.get_book_by_id(session, id)
     if book:
-        return book
-    return {"error": "Book not found"}
+        return etag_response(book, book_etag(book))
+    raise HTTPException(status_code=404, detail="Book not found")
 
 
 @app.put("/books/{book_id}", response_model=SchemaBook)
-async def update_book(book_id: int, book_data: Book):
-    updated_book = await BookRepository.update_book(book_id, book_data.model_dump())
+async def update_book(book_id: int, book_data: Book,
+                      if_match: Optional[str] = Header(None),
+                      session: AsyncSession = Depends(get_session)):
+    try:
+        updated_book = await BookRepository.update_book(session, book_id, book_data.model_dump(), if_match_etag(if_match))
+    except VersionConflictError as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except DuplicateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if not updated_book:
         raise HTTPException(status_code=404, detail="Book not found")
-    return updated_book
+    return etag_response(updated_book, book_etag(updated_book), headers=consistency_headers(session))
 
 
 
 @app.delete("/books/{id}", response_model=SchemaBook)
-async def delete_book(id: int):
-    deleted_book = await BookRepository.delete_book(id)
+async def delete_book(id: int, session: AsyncSession = Depends(get_session)):
+    try:
+        deleted_book = await BookRepository.delete_book(session, id)
+    except BookBorrowedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if deleted_book:
         return deleted_book
     return {"error": "Book not found"}
@@ -108,33 +320,60 @@ async def delete_book(id: int):
 # Эндпоинтs для выдач
 
 @app.post("/borrows", response_model=Borrow)
-async def create_borrow(borrow: Borrow):
-    new_borrow = await BorrowRepository.create_borrow(borrow.model_dump())
+async def create_borrow(borrow: Borrow, session: AsyncSession = Depends(get_session)):
+    try:
+        new_borrow = await BorrowRepository.create_borrow(session, borrow.model_dump())
+    except BookNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except BookNotAvailableError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     return new_borrow
 
 
-@app.get("/borrows", response_model=List[Borrow])
-async def get_borrows():
-    borrows = await BorrowRepository.get_borrows()
-    return borrows
+@app.get("/borrows", response_model=List[SchemaBarrow])
+async def get_borrows(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                      after: Optional[str] = None,
+                      since: Optional[date] = None,
+                      if_none_match: Optional[str] = Header(None),
+                      session: AsyncSession = Depends(get_read_session)):
+    borrows = await BorrowRepository.get_borrows(session, limit + 1, decode_cursor(after, 'id'), since)
+    return page_response(*paginate(borrows, limit, 'id'), borrow_etag, if_none_match)
+
 
+@app.get("/borrows/export")
+async def export_borrows(format: Literal['ndjson', 'csv'] = 'ndjson',
+                         x_consistency_token: Optional[str] = Header(None)):
+    return export_response(BorrowRepository.stream_borrows, BORROW_COLUMNS, format, x_consistency_token)
 
-@app.get("/borrows/{id}", response_model=Borrow)
-async def get_borrow_by_id(id: int):
-    borrow = await BorrowRepository.get_borrow_by_id(id)
+
+@app.get("/borrows/{id}", response_model=SchemaBarrow)
+async def get_borrow_by_id(id: int,
+                           if_none_match: Optional[str] = Header(None),
+                           session: AsyncSession = Depends(get_read_session)):
+    borrow = await BorrowRepository.get_borrow_by_id(session, id)
     if borrow:
-        return borrow
-    return {"error": "Borrow not found"}
+        return etag_response(borrow, borrow_etag(borrow), if_none_match)
+    raise HTTPException(status_code=404, detail="Borrow not found")
 
 
 @app.patch("/borrows/{id}/return", response_model=SchemaBarrow)
-async def return_borrow(id: int, return_date):
-    returned_borrow = await BorrowRepository.return_borrow(id, return_date)
+async def return_borrow(id: int, return_date: date, session: AsyncSession = Depends(get_session)):
+    returned_borrow = await BorrowRepository.return_borrow(session, id, return_date)
     if returned_borrow:
         return returned_borrow
     return {"error": "Borrow not found"}
 
 
+@app.get("/cache/stats", include_in_schema=False)
+async def cache_stats():
+    return cache.stats()
+
+
+@app.get("/archive/stats", include_in_schema=False)
+async def archive_stats():
+    return archive_progress.stats()
+
+
 if __name__ == "__main__":
     import uvicorn
 
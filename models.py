@@ -11,6 +11,7 @@ class Author(BaseModel):
 
 class SchemaAuthor(Author):
     id: int
+    version: Optional[int] = None
     model_config = ConfigDict(from_attributes=True)
 
 class Book(BaseModel):
@@ -22,6 +23,7 @@ class Book(BaseModel):
 
 class SchemaBook(Book):
     id: int
+    version: Optional[int] = None
     model_config = ConfigDict(from_attributes=True)
 
 
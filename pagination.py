@@ -0,0 +1,72 @@
+import base64
+import binascii
+import json
+from collections.abc import Mapping
+
+from sqlalchemy import and_, or_, tuple_
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def _value(item, name: str):
+    if isinstance(item, Mapping):
+        return item[name]
+    return getattr(item, name)
+
+
+def cursor_key(item, order_by: str) -> list:
+    # Ключ курсора: значение колонки сортировки и id как tie-breaker
+    if order_by == 'id':
+        return [_value(item, 'id')]
+    return [_value(item, order_by), _value(item, 'id')]
+
+
+def encode_cursor(order_by: str, key: list) -> str:
+    payload = json.dumps({'o': order_by, 'k': key}, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str | None, order_by: str) -> list | None:
+    if token is None:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        key = payload['k']
+        cursor_order = payload['o']
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise InvalidCursorError("Некорректный курсор пагинации.")
+    if cursor_order != order_by or not isinstance(key, list):
+        raise InvalidCursorError("Курсор получен для другой сортировки.")
+    return key
+
+
+def keyset_after(sort_column, id_column, after: list | None):
+    # Условие "строго после курсора" для ORDER BY sort_column, id
+    if after is None:
+        return None
+    if sort_column is id_column:
+        return id_column > after[0]
+    return tuple_(sort_column, id_column) > tuple(after)
+
+
+def keyset_after_ranked(rank_column, id_column, after: list | None):
+    # То же для ORDER BY rank DESC, id: ранг убывает, id растёт
+    if after is None:
+        return None
+    rank, id = after
+    return or_(rank_column < rank, and_(rank_column == rank, id_column > id))
+
+
+def paginate(items: list, limit: int, order_by: str) -> tuple[list, str | None]:
+    # Репозиторий запрашивает limit + 1 строк: лишняя строка означает, что
+    # есть следующая страница
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(order_by, cursor_key(items[-1], order_by))
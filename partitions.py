@@ -0,0 +1,120 @@
+import argparse
+import asyncio
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from config import settings
+
+# В Postgres таблица borrow секционирована по borrow_date: секция на месяц плюс
+# секция по умолчанию для дат, под которые месячной секции нет
+DEFAULT_PARTITION = 'borrow_default'
+DEFAULT_PARTITION_SQL = f'CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF borrow DEFAULT'
+
+# Ключ advisory-блокировки: несколько воркеров не создают одну секцию одновременно
+PARTITION_LOCK_KEY = 0x626f72726f77
+# CREATE TABLE ... PARTITION OF берёт эксклюзивную блокировку родителя: лучше
+# отступить и повторить позже, чем копить за собой очередь запросов
+PARTITION_LOCK_TIMEOUT = '2s'
+
+EXISTING_PARTITIONS = text('SELECT name FROM unnest(CAST(:names AS text[])) AS name WHERE to_regclass(name) IS NOT NULL')
+# Выдача с датой за пределами созданных секций попадает в секцию по умолчанию.
+# Пока там есть строки месяца, секцию этого месяца создать нельзя (проверка
+# секции по умолчанию упадёт): строки переносятся вместе с созданием секции
+STRAY_ROWS = text(f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE borrow_date >= :start AND borrow_date < :end)')
+MOVE_STRAY_ROWS = text(f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE borrow_date >= :start AND borrow_date < :end '
+                       'RETURNING *) INSERT INTO borrow SELECT * FROM moved')
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'borrow_{month.year:04d}_{month.month:02d}'
+
+
+def create_partition_sql(month: date) -> str:
+    month = month.replace(day=1)
+    return (f'CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF borrow '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')")
+
+
+async def missing_borrow_partitions(connection: AsyncConnection, months_ahead: int,
+                                    today: date | None = None) -> list[date]:
+    # Секции текущего месяца и months_ahead следующих. Создаются заранее: пока
+    # месяц не начался, секция по умолчанию обычно пуста
+    first = (today or date.today()).replace(day=1)
+    months = [add_months(first, offset) for offset in range(months_ahead + 1)]
+    names = [partition_name(month) for month in months]
+    existing = set((await connection.execute(EXISTING_PARTITIONS, {'names': names})).scalars())
+    return [month for month in months if partition_name(month) not in existing]
+
+
+async def create_borrow_partition(connection: AsyncConnection, month: date) -> bool:
+    await connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': PARTITION_LOCK_KEY})
+    await connection.execute(text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+    # Другой воркер мог создать секцию, пока мы ждали блокировку
+    name = partition_name(month)
+    if await connection.scalar(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': name}):
+        return False
+
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    if not await connection.scalar(STRAY_ROWS, bounds):
+        await connection.execute(text(create_partition_sql(month)))
+        return True
+
+    # Секция по умолчанию отсоединяется на время переноса: новая секция создаётся
+    # без проверки её строк, а INSERT в borrow направляет строки уже в новую секцию
+    await connection.execute(text(f'ALTER TABLE borrow DETACH PARTITION {DEFAULT_PARTITION}'))
+    await connection.execute(text(create_partition_sql(month)))
+    await connection.execute(MOVE_STRAY_ROWS, bounds)
+    await connection.execute(text(f'ALTER TABLE borrow ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT'))
+    return True
+
+
+async def ensure_borrow_partitions(engine: AsyncEngine, months_ahead: int, today: date | None = None) -> list[str]:
+    async with engine.connect() as connection:
+        missing = await missing_borrow_partitions(connection, months_ahead, today)
+
+    # Каждая секция -- своя транзакция: ошибка одного месяца не мешает создать
+    # остальные, неудавшийся месяц повторится на следующем проходе
+    created = []
+    for month in missing:
+        try:
+            async with engine.begin() as connection:
+                if await create_borrow_partition(connection, month):
+                    created.append(partition_name(month))
+        except DBAPIError as e:
+            print(f"Не удалось создать секцию {partition_name(month)}: {e}")
+    return created
+
+
+async def maintain_borrow_partitions(engine: AsyncEngine, months_ahead: int, interval: float) -> None:
+    while True:
+        try:
+            created = await ensure_borrow_partitions(engine, months_ahead)
+            if created:
+                print(f"Созданы секции выдач: {', '.join(created)}")
+        except (DBAPIError, OSError) as e:
+            print(f"Не удалось создать секции выдач: {e}")
+        await asyncio.sleep(interval)
+
+
+async def run(args: argparse.Namespace) -> None:
+    # database импортирует этот модуль, поэтому движок берётся только здесь
+    from database import engine
+    try:
+        created = await ensure_borrow_partitions(engine, args.months_ahead)
+    finally:
+        await engine.dispose()
+    print(f"Созданы секции выдач: {', '.join(created)}" if created else "Все секции выдач уже созданы")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Создание месячных секций borrow заранее')
+    parser.add_argument('--months-ahead', type=int, default=settings.BORROW_PARTITION_MONTHS_AHEAD)
+    asyncio.run(run(parser.parse_args()))
@@ -1,312 +1,811 @@
 
 from datetime import date, datetime
-from typing import List
+from typing import AsyncIterator, Sequence
 
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+import re
 
-from database import new_session, AuthorOrm, BookOrm, BorrowOrm
-from models import SchemaAuthor, Book, Author, SchemaBook
+from sqlalchemy import RowMapping, delete, exists, func, literal, select, text, true, update
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from archive import ARCHIVE_COLUMNS
+from cache import cache
+from config import settings
+from database import AUTHOR_FULL_NAME, AUTHOR_IDENTITY, BOOK_IDENTITY, BOOK_SEARCH_VECTOR, IS_POSTGRES, AuthorOrm, BookOrm, BorrowOrm
+from database import BorrowArchiveOrm
+from database import CACHE_FILL, CACHE_READ, author_identity_key, insert
+from models import SchemaAuthor, Book, Author
+from pagination import DEFAULT_PAGE_SIZE, keyset_after, keyset_after_ranked
+from search_index import book_index
+from utils import make_etag, parse_etag
+
+
+class BookNotFoundError(ValueError):
+    pass
+
+
+class BookNotAvailableError(ValueError):
+    pass
+
+
+class BookBorrowedError(ValueError):
+    pass
+
+
+class VersionConflictError(ValueError):
+    pass
+
+
+class SearchUnavailableError(ValueError):
+    pass
+
+
+class DuplicateError(ValueError):
+    pass
+
+
+TRGM_INSTALLED = text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+# Запоминается только найденное расширение: после CREATE EXTENSION поиск
+# заработает без перезапуска
+trgm_installed = False
+
+
+# Колонки, по которым разрешена keyset-пагинация списка книг
+BOOK_SORT_COLUMNS = {
+    'id': BookOrm.id,
+    'title': BookOrm.title,
+}
+
+# Плоские проекции для чтения: списки, карточки и выгрузка каталога выбирают
+# только эти колонки, без ORM-объектов и identity map
+BOOK_COLUMNS = (
+    BookOrm.id,
+    BookOrm.title,
+    BookOrm.description,
+    BookOrm.available_copies,
+    BookOrm.author_id,
+    BookOrm.version,
+    AuthorOrm.first_name.label('author_first_name'),
+    AuthorOrm.last_name.label('author_last_name'),
+    AuthorOrm.birth_date.label('author_birth_date'),
+    AuthorOrm.version.label('author_version'),
+)
+
+AUTHOR_COLUMNS = (
+    AuthorOrm.id,
+    AuthorOrm.first_name,
+    AuthorOrm.last_name,
+    AuthorOrm.birth_date,
+    AuthorOrm.version,
+)
+
+# Текст книги для встроенного поискового индекса
+BOOK_SEARCH_COLUMNS = (
+    BookOrm.id,
+    BookOrm.title,
+    BookOrm.description,
+    AuthorOrm.first_name,
+    AuthorOrm.last_name,
+)
+
+# Без полнотекстового поиска Postgres /books/search обслуживает индекс в памяти
+# процесса: он строится при старте и обновляется записями репозитория
+USE_SEARCH_INDEX = not IS_POSTGRES
+
+BORROW_COLUMNS = (
+    BorrowOrm.id,
+    BorrowOrm.book_id,
+    BorrowOrm.borrower_name,
+    BorrowOrm.borrow_date,
+    BorrowOrm.return_date,
+)
+
+
+def prefix_tsquery(q: str) -> str | None:
+    # Каждое слово запроса -- префикс: "дюн герб" найдёт "Дюна" Герберта.
+    # В tsquery попадают только буквы и цифры, поэтому синтаксис не сломать
+    words = re.findall(r'\w+', q)
+    if not words:
+        return None
+    return ' & '.join(f'{word}:*' for word in words)
+
+
+def _as_date(value: datetime | None) -> date | None:
+    return value.date() if value is not None else None
+
+
+def author_row_to_dict(row) -> dict:
+    id, first_name, last_name, birth_date, version = row
+    return {
+        'id': id,
+        'first_name': first_name,
+        'last_name': last_name,
+        'birth_date': _as_date(birth_date),
+        'version': version,
+    }
+
+
+def book_row_to_dict(row) -> dict:
+    # Строка BOOK_COLUMNS сразу в форме ответа SchemaBook
+    (id, title, description, available_copies, author_id, version,
+     first_name, last_name, birth_date, author_version) = row
+    return {
+        'id': id,
+        'title': title,
+        'description': description,
+        'available_copies': available_copies,
+        'version': version,
+        'author': {
+            'id': author_id,
+            'first_name': first_name,
+            'last_name': last_name,
+            'birth_date': _as_date(birth_date),
+            'version': author_version,
+        } if author_id is not None else None,
+    }
+
+
+def borrow_row_to_dict(row) -> dict:
+    id, book_id, borrower_name, borrow_date, return_date = row
+    return {
+        'id': id,
+        'book_id': book_id,
+        'borrower_name': borrower_name,
+        'borrow_date': _as_date(borrow_date),
+        'return_date': _as_date(return_date),
+    }
+
+
+def book_card_query():
+    return select(*BOOK_COLUMNS).outerjoin(AuthorOrm, BookOrm.author_id == AuthorOrm.id)
+
+
+def book_versions_query(id: int):
+    return (select(BookOrm.version, AuthorOrm.version)
+            .outerjoin(AuthorOrm, BookOrm.author_id == AuthorOrm.id)
+            .where(BookOrm.id == id))
+
+
+def books_page_query(limit: int, after: list | None, order_by: str):
+    sort_column = BOOK_SORT_COLUMNS[order_by]
+    query = select(BookOrm.id).order_by(sort_column, BookOrm.id).limit(limit)
+    if after is not None:
+        query = query.where(keyset_after(sort_column, BookOrm.id, after))
+    return query
+
+
+def authors_page_query(limit: int, after: list | None):
+    query = select(*AUTHOR_COLUMNS).order_by(AuthorOrm.id).limit(limit)
+    if after is not None:
+        query = query.where(keyset_after(AuthorOrm.id, AuthorOrm.id, after))
+    return query
+
+
+def borrows_page_query(limit: int, after: list | None, since: date | None = None):
+    query = select(*BORROW_COLUMNS).order_by(BorrowOrm.id).limit(limit)
+    if after is not None:
+        query = query.where(keyset_after(BorrowOrm.id, BorrowOrm.id, after))
+    if since is not None:
+        # Условие по ключу секционирования: Postgres читает только секции с since
+        query = query.where(BorrowOrm.borrow_date >= since)
+    return query
+
+
+def warmup_statements() -> list:
+    # Горячие чтения в том же виде, что и в методах репозитория (с курсором и без):
+    # на прогретом соединении asyncpg уже подготовил их, первый запрос не платит за prepare
+    return [
+        book_card_query().where(BookOrm.id == 0),
+        book_versions_query(0),
+        books_page_query(DEFAULT_PAGE_SIZE + 1, None, 'id'),
+        books_page_query(DEFAULT_PAGE_SIZE + 1, [0], 'id'),
+        books_page_query(DEFAULT_PAGE_SIZE + 1, None, 'title'),
+        books_page_query(DEFAULT_PAGE_SIZE + 1, ['', 0], 'title'),
+        select(*AUTHOR_COLUMNS).where(AuthorOrm.id == 0),
+        select(AuthorOrm.version).where(AuthorOrm.id == 0),
+        authors_page_query(DEFAULT_PAGE_SIZE + 1, None),
+        authors_page_query(DEFAULT_PAGE_SIZE + 1, [0]),
+        select(*BORROW_COLUMNS).where(BorrowOrm.id == 0),
+        borrows_page_query(DEFAULT_PAGE_SIZE + 1, None),
+        borrows_page_query(DEFAULT_PAGE_SIZE + 1, [0]),
+    ]
+
+
+def book_etag(book: dict) -> str:
+    # Карточка книги включает автора, поэтому ETag зависит и от его версии
+    author_version = book['author']['version'] if book['author'] is not None else 0
+    return make_etag(book['id'], book['version'], author_version)
+
+
+def author_etag(author: dict) -> str:
+    return make_etag(author['id'], author['version'])
+
+
+def borrow_etag(borrow: dict) -> str:
+    # У выдачи после создания меняется только дата возврата
+    return make_etag(borrow['id'], borrow['return_date'] or '')
+
+
+def expected_versions(etag: str, id: int, size: int) -> tuple[int, ...]:
+    # Версии из ETag заголовка If-Match; чужой или испорченный ETag не может совпасть
+    try:
+        expected = parse_etag(etag)
+    except ValueError:
+        expected = ()
+    if len(expected) != size or expected[0] != id:
+        raise VersionConflictError("ETag не совпадает с текущей версией.")
+    return expected
+
+
+def search_document(row) -> tuple[int, str, str | None, str]:
+    id, title, description, first_name, last_name = row
+    return id, title, description, ' '.join(name for name in (first_name, last_name) if name)
+
+
+async def reindex_books(session: AsyncSession, condition) -> None:
+    if not USE_SEARCH_INDEX:
+        return
+    result = await session.execute(
+        select(*BOOK_SEARCH_COLUMNS)
+        .outerjoin(AuthorOrm, BookOrm.author_id == AuthorOrm.id)
+        .where(condition)
+    )
+    for row in result:
+        book_index.add(*search_document(row))
+
+
+def book_key(book_id: int) -> str:
+    return f'book:{book_id}'
+
+
+def author_key(author_id: int) -> str:
+    return f'author:{author_id}'
+
+
+def book_tags(book: dict) -> tuple[str, ...]:
+    # Карточка книги содержит данные автора и сбрасывается вместе с ним
+    return (author_key(book['author']['id']),) if book['author'] is not None else ()
+
+
+async def get_cached(session: AsyncSession, keys: list[str]) -> list:
+    if not session.info.get(CACHE_READ, True):
+        return [None] * len(keys)
+    return await cache.get_many(keys)
+
+
+async def set_cached(session: AsyncSession, items: dict) -> None:
+    if session.info.get(CACHE_FILL, True):
+        await cache.set_many(items)
+
+
+async def invalidate_books(*book_ids: int) -> None:
+    await cache.delete(*(book_key(book_id) for book_id in book_ids))
+
+
+async def invalidate_author(author_id: int) -> None:
+    await cache.delete(author_key(author_id))
+    await cache.invalidate_tags(author_key(author_id))
 
 
 class AuthorRepository:
     @classmethod
-    async def create_author(cls, data: Author):
-        async with new_session() as session:
-            model = data.model_dump()
-            existing_author = await cls.get_author_by_details(data=AuthorOrm(**model))
+    def upsert_author_statement(cls, author_data: dict | list[dict]):
+        # INSERT ... ON CONFLICT по уникальному индексу uq_author_identity:
+        # существующий автор возвращается тем же запросом, без отдельного SELECT
+        statement = insert(AuthorOrm).values(author_data)
+        return statement.on_conflict_do_update(
+            index_elements=AUTHOR_IDENTITY,
+            set_={'first_name': AuthorOrm.first_name},
+        )
 
-            if existing_author:
-                return existing_author
-            else:
-                new_model = AuthorOrm(**model)
-                session.add(new_model)
-                await session.flush()
-                await session.commit()
-                return new_model
+    @classmethod
+    async def create_author(cls, session: AsyncSession, data: Author):
+        model = data.model_dump()
+        result = await session.scalars(
+            cls.upsert_author_statement(model).returning(AuthorOrm),
+            execution_options={'populate_existing': True},
+        )
+        author = result.one()
+        await session.commit()
+        return author
 
     @classmethod
-    async def get_author_by_details(cls, data: AuthorOrm):
-        async with new_session() as session:
-            result = await session.execute(select(AuthorOrm).filter(
-                (data.first_name == AuthorOrm.first_name) &
-                (data.last_name == AuthorOrm.last_name) &
-                (data.birth_date == AuthorOrm.birth_date)))
-
-            author = result.scalars().first()
-            return author
+    async def get_author_by_details(cls, session: AsyncSession, data: AuthorOrm):
+        key = author_identity_key(data.first_name, data.last_name, data.birth_date)
+        result = await session.execute(select(AuthorOrm).filter(
+            *(expression == value for expression, value in zip(AUTHOR_IDENTITY, key))))
+
+        author = result.scalars().first()
+        return author
+
+    @classmethod
+    async def search_authors(cls, session: AsyncSession, q: str, limit: int, threshold: float,
+                             after: list | None = None) -> list[dict]:
+        # Нечёткий поиск по полному имени: оператор % использует GIN-индекс
+        # ix_author_full_name_trgm с порогом из pg_trgm.similarity_threshold,
+        # выдача по убыванию сходства, keyset-пагинация по (similarity, id)
+        global trgm_installed
+        if not trgm_installed:
+            trgm_installed = IS_POSTGRES and bool(await session.scalar(TRGM_INSTALLED))
+            if not trgm_installed:
+                raise SearchUnavailableError("Нечёткий поиск авторов недоступен: в базе нет расширения pg_trgm.")
+        name = ' '.join(q.lower().split())
+        await session.execute(select(func.set_config('pg_trgm.similarity_threshold', str(threshold), True)))
+        similarity = func.similarity(AUTHOR_FULL_NAME, name)
+        statement = (select(*AUTHOR_COLUMNS, similarity.label('similarity'))
+                     .where(AUTHOR_FULL_NAME.bool_op('%')(name))
+                     .order_by(similarity.desc(), AuthorOrm.id)
+                     .limit(limit))
+        if after is not None:
+            statement = statement.where(keyset_after_ranked(similarity, AuthorOrm.id, after))
+        result = await session.execute(statement)
+        authors = []
+        for row in result:
+            author = author_row_to_dict(row[:-1])
+            author['similarity'] = row.similarity
+            authors.append(author)
+        return authors
+
+    @classmethod
+    async def get_authors(cls, session: AsyncSession, limit: int, after: list | None = None) -> list[dict]:
+        result = await session.execute(authors_page_query(limit, after))
+        return [author_row_to_dict(row) for row in result]
 
     @classmethod
-    async def get_authors(cls) -> list[AuthorOrm]:
-        async with new_session() as session:
-            query = select(AuthorOrm)
-            result = await session.execute(query)
-            authors = result.scalars().all()
-            return authors if authors else []
+    async def get_author_by_id(cls, session: AsyncSession, id: int) -> dict | None:
+        [author] = await get_cached(session, [author_key(id)])
+        if author is not None:
+            return author
+        result = await session.execute(select(*AUTHOR_COLUMNS).where(AuthorOrm.id == id))
+        row = result.first()
+        if row is None:
+            return None
+        author = author_row_to_dict(row)
+        await set_cached(session, {author_key(id): (author, ())})
+        return author
 
     @classmethod
-    async def get_author_by_id(cls, id: int) -> AuthorOrm | None:
-        async with new_session() as session:
-            author = await session.get(AuthorOrm, id)
-            return author if author else None
+    async def get_author_etag(cls, session: AsyncSession, id: int) -> str | None:
+        # Для If-None-Match хватает карточки из кэша или одной колонки версии
+        [author] = await get_cached(session, [author_key(id)])
+        if author is not None:
+            return author_etag(author)
+        version = await session.scalar(select(AuthorOrm.version).where(AuthorOrm.id == id))
+        return make_etag(id, version) if version is not None else None
 
 
     @classmethod
-    async def update_author(cls, id: int, author_data: dict) -> AuthorOrm:
-        async with new_session() as session:
-            stored_author = await session.get(AuthorOrm, id)
-            if stored_author:
-                for key, value in author_data.items():
-                    setattr(stored_author, key, value)
-                await session.commit()
-                return stored_author
+    async def update_author(cls, session: AsyncSession, id: int, author_data: dict,
+                            expected_etag: str | None = None) -> dict | None:
+        # Один UPDATE ... RETURNING; с If-Match условие на версию делает запись
+        # оптимистичной: чужое изменение между чтением и записью даёт 412
+        statement = update(AuthorOrm).where(AuthorOrm.id == id)
+        if expected_etag is not None:
+            expected = expected_versions(expected_etag, id, 2)
+            statement = statement.where(AuthorOrm.version == expected[1])
+        try:
+            result = await session.execute(
+                statement.values(**author_data, version=AuthorOrm.version + 1).returning(*AUTHOR_COLUMNS))
+        except IntegrityError:
+            # Новые имя и дата рождения совпали с другим автором (uq_author_identity)
+            await session.rollback()
+            raise DuplicateError("Автор с таким именем и датой рождения уже есть.")
+        row = result.first()
+        if row is None:
+            if expected_etag is not None and await session.scalar(select(AuthorOrm.id).where(AuthorOrm.id == id)):
+                raise VersionConflictError("Автор был изменён другим запросом.")
             return None
+        await session.commit()
+        await invalidate_author(id)
+        await reindex_books(session, BookOrm.author_id == id)
+        return author_row_to_dict(row)
 
     @classmethod
-    async def delete_author(cls, id: int) -> SchemaAuthor:
-        async with new_session() as session:
-            author_to_delete = await session.get(AuthorOrm, id)
-            if author_to_delete:
-                await session.delete(author_to_delete)
-                await session.commit()
-                return author_to_delete
+    async def delete_author(cls, session: AsyncSession, id: int) -> SchemaAuthor:
+        author_to_delete = await session.get(AuthorOrm, id)
+        if author_to_delete is None:
             return None
+        book_ids = []
+        if USE_SEARCH_INDEX:
+            # После удаления книги автора уже не найти по author_id
+            book_ids = (await session.scalars(select(BookOrm.id).where(BookOrm.author_id == id))).all()
+        merged = await cls._merge_into_authorless_books(session, id)
+        # Остальные книги остаются в каталоге без автора
+        await session.execute(
+            update(BookOrm)
+            .where(BookOrm.author_id == id)
+            .values(author_id=None, version=BookOrm.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(delete(AuthorOrm).where(AuthorOrm.id == id))
+        await session.commit()
+        await invalidate_author(id)
+        await invalidate_books(*merged, *merged.values())
+        if USE_SEARCH_INDEX:
+            for book_id in merged:
+                book_index.remove(book_id)
+        await reindex_books(session, BookOrm.id.in_([*book_ids, *merged.values()]))
+        return author_to_delete
+
+    @classmethod
+    async def _merge_into_authorless_books(cls, session: AsyncSession, author_id: int) -> dict[int, int]:
+        # Без автора книга с тем же названием, что у уже существующей книги без
+        # автора, нарушила бы uq_book_identity. Такие книги сливаются: копии и
+        # выдачи переходят к существующей книге. Результат -- {удалённая: оставшаяся}
+        authorless = aliased(BookOrm)
+        result = await session.execute(
+            select(BookOrm.id, authorless.id, BookOrm.available_copies)
+            .join(authorless, (authorless.author_id.is_(None))
+                  & (func.lower(func.btrim(authorless.title)) == func.lower(func.btrim(BookOrm.title))))
+            .where(BookOrm.author_id == author_id)
+        )
+        merged = {}
+        for book_id, target_id, copies in result.all():
+            await session.execute(
+                update(BookOrm)
+                .where(BookOrm.id == target_id)
+                .values(available_copies=BookOrm.available_copies + copies, version=BookOrm.version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            await session.execute(
+                update(BorrowOrm).where(BorrowOrm.book_id == book_id).values(book_id=target_id)
+                .execution_options(synchronize_session=False)
+            )
+            await session.execute(delete(BookOrm).where(BookOrm.id == book_id))
+            merged[book_id] = target_id
+        return merged
 
 
 class BookRepository:
     @classmethod
-    async def create_book(cls, book_data: Book):
-        async with new_session() as session:
-            data = book_data.model_dump()
-            author_data = data['author']
+    async def create_book(cls, session: AsyncSession, book_data: Book):
+        data = book_data.model_dump()
+        author_data = data['author']
+
+        # Автор и книга пишутся одним запросом: upsert автора в CTE, затем
+        # INSERT ... ON CONFLICT по uq_book_identity, который для уже известной
+        # книги просто добавляет копию
+        author = None
+        if author_data and IS_POSTGRES:
+            author = AuthorRepository.upsert_author_statement(author_data).returning(AuthorOrm.id).cte('author_upsert')
+            author_id = author.c.id
+        elif author_data:
+            # SQLite не поддерживает изменяющие запросы в WITH: автор пишется отдельно
+            result = await session.execute(
+                AuthorRepository.upsert_author_statement(author_data).returning(AuthorOrm.id))
+            author_id = literal(result.scalar_one(), BookOrm.author_id.type)
+        else:
+            author_id = literal(None, BookOrm.author_id.type)
+
+        statement = insert(BookOrm).from_select(
+            ['title', 'description', 'available_copies', 'author_id'],
+            select(
+                literal(data['title'], BookOrm.title.type),
+                literal(data['description'], BookOrm.description.type),
+                literal(1, BookOrm.available_copies.type),
+                author_id,
+            # WHERE нужен SQLite, чтобы ON CONFLICT не разбирался как часть JOIN
+            ).where(true()),
+            # version берётся из server_default колонки
+            include_defaults=False,
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=BOOK_IDENTITY,
+            set_={'available_copies': BookOrm.available_copies + 1, 'version': BookOrm.version + 1},
+        ).returning(BookOrm)
+        if author is not None:
+            statement = statement.add_cte(author)
+
+        result = await session.scalars(statement, execution_options={'populate_existing': True})
+        book = result.one()
+        await session.commit()
+        # Для уже известной книги изменился остаток
+        await invalidate_books(book.id)
+        await reindex_books(session, BookOrm.id == book.id)
+        return book
 
-            existing_author = await cls.get_existing_author(AuthorOrm(**author_data))
+    @classmethod
+    async def get_books(cls, session: AsyncSession, limit: int, after: list | None = None,
+                        order_by: str = 'id') -> list[dict]:
+        # Страница собирается в три шага: id страницы из индекса, карточки одним
+        # multi-get из кэша, недостающие карточки одним запросом с id IN (...)
+        book_ids = (await session.scalars(books_page_query(limit, after, order_by))).all()
+        books = await cls.get_books_by_ids(session, book_ids)
+        # Книга могла быть удалена между запросами
+        return [books[book_id] for book_id in book_ids if book_id in books]
 
-            if existing_author:
-                author_id = existing_author.id
-            else:
-                new_author = AuthorOrm(**author_data)
-                session.add(new_author)
-                await session.flush()
-                author_id = new_author.id
+    @classmethod
+    async def get_books_by_ids(cls, session: AsyncSession, book_ids: Sequence[int]) -> dict[int, dict]:
+        cached = await get_cached(session, [book_key(book_id) for book_id in book_ids])
+        books = {book['id']: book for book in cached if book is not None}
+        missing = [book_id for book_id in book_ids if book_id not in books]
+        if missing:
+            result = await session.execute(book_card_query().where(BookOrm.id.in_(missing)))
+            loaded = {row.id: book_row_to_dict(row) for row in result}
+            await set_cached(session, {book_key(book_id): (book, book_tags(book)) for book_id, book in loaded.items()})
+            books.update(loaded)
+        return books
 
-            query = await session.execute(
-                select(BookOrm).filter(BookOrm.title == data['title'], BookOrm.author_id == author_id)
+    @classmethod
+    async def bulk_create_books(cls, session: AsyncSession, books: list[tuple[Book, int]]) -> list[str | None]:
+        # Пачка книг (книга, число копий) пишется двумя многострочными upsert-запросами.
+        # Результат -- по элементу на книгу: None или текст ошибки
+        errors: list[str | None] = [None] * len(books)
+
+        # Авторы пачки: уникальные по нормализованному ключу, иначе ON CONFLICT
+        # попытается обновить одну строку дважды в одном запросе
+        authors = {}
+        for book, _ in books:
+            if book.author:
+                author = book.author.model_dump()
+                key = author_identity_key(author['first_name'], author['last_name'], author['birth_date'])
+                authors.setdefault(key, author)
+
+        author_ids = {}
+        if authors:
+            result = await session.execute(
+                AuthorRepository.upsert_author_statement(list(authors.values()))
+                .returning(AuthorOrm.id, AuthorOrm.first_name, AuthorOrm.last_name, AuthorOrm.birth_date)
             )
-            existing_book = query.scalars().first()
-
-            if existing_book:
-                existing_book.available_copies += 1
-                await session.commit()
-                return existing_book
+            for row in result:
+                author_ids[author_identity_key(row.first_name, row.last_name, row.birth_date)] = row.id
+
+        # Книги пачки: одинаковые экземпляры сливаются в одну строку с суммой копий
+        rows = {}
+        for index, (book, copies) in enumerate(books):
+            author_id = None
+            if book.author:
+                author = book.author
+                author_id = author_ids.get(author_identity_key(author.first_name, author.last_name, author.birth_date))
+                if author_id is None:
+                    errors[index] = "Не удалось сопоставить автора."
+                    continue
+            # strip(' '), как btrim в BOOK_IDENTITY: табуляции и неразрывные
+            # пробелы остаются частью названия
+            key = (author_id or 0, book.title.strip(' ').lower())
+            if key in rows:
+                rows[key]['available_copies'] += copies
             else:
-                new_book_data = data.copy()
-                new_book_data['available_copies'] = 1
+                rows[key] = {
+                    'title': book.title,
+                    'description': book.description,
+                    'available_copies': copies,
+                    'author_id': author_id,
+                }
+
+        if rows:
+            statement = insert(BookOrm).values(list(rows.values()))
+            result = await session.execute(statement.on_conflict_do_update(
+                index_elements=BOOK_IDENTITY,
+                set_={
+                    'available_copies': BookOrm.available_copies + statement.excluded.available_copies,
+                    'version': BookOrm.version + 1,
+                },
+            ).returning(BookOrm.id))
+            book_ids = result.scalars().all()
+        else:
+            book_ids = []
+        await session.commit()
+        await invalidate_books(*book_ids)
+        await reindex_books(session, BookOrm.id.in_(book_ids))
+        return errors
 
-                new_book = BookOrm(title=new_book_data['title'],
-                                   description=new_book_data['description'],
-                                   available_copies=new_book_data['available_copies'],
-                                   author_id=author_id)
+    @classmethod
+    async def search_books(cls, session: AsyncSession, q: str, limit: int,
+                           after: list | None = None) -> list[dict]:
+        # Поиск по GIN-индексу book.search_vector, выдача по убыванию ts_rank,
+        # keyset-пагинация по (rank, id)
+        if USE_SEARCH_INDEX:
+            return await cls.search_books_in_index(session, q, limit, after)
+        tsquery = prefix_tsquery(q)
+        if tsquery is None:
+            return []
+        query = func.to_tsquery(literal(settings.SEARCH_CONFIG).cast(REGCONFIG), tsquery)
+        rank = func.ts_rank(BOOK_SEARCH_VECTOR, query)
+        statement = (select(*BOOK_COLUMNS, rank.label('rank'))
+                     .outerjoin(AuthorOrm, BookOrm.author_id == AuthorOrm.id)
+                     .where(BOOK_SEARCH_VECTOR.bool_op('@@')(query))
+                     .order_by(rank.desc(), BookOrm.id)
+                     .limit(limit))
+        if after is not None:
+            statement = statement.where(keyset_after_ranked(rank, BookOrm.id, after))
+        result = await session.execute(statement)
+        books = []
+        for row in result:
+            book = book_row_to_dict(row[:-1])
+            book['rank'] = row.rank
+            books.append(book)
+        return books
 
-                session.add(new_book)
-                await session.flush()
-                await session.commit()
+    @classmethod
+    async def search_books_in_index(cls, session: AsyncSession, q: str, limit: int,
+                                    after: list | None = None) -> list[dict]:
+        # Ранжирование целиком в индексе, из базы (или кэша) читаются только карточки страницы
+        hits = book_index.search(q, limit, after)
+        books = await cls.get_books_by_ids(session, [book_id for _, book_id in hits])
+        page = []
+        for rank, book_id in hits:
+            if book_id in books:
+                page.append({**books[book_id], 'rank': rank})
+        return page
 
-                return new_book
+    @classmethod
+    async def build_search_index(cls, session: AsyncSession, chunk_size: int) -> None:
+        documents = []
+        result = await session.stream(
+            select(*BOOK_SEARCH_COLUMNS)
+            .outerjoin(AuthorOrm, BookOrm.author_id == AuthorOrm.id)
+            .order_by(BookOrm.id)
+            .execution_options(yield_per=chunk_size)
+        )
+        async for rows in result.partitions():
+            documents.extend(search_document(row) for row in rows)
+        book_index.build(documents)
 
+    @classmethod
+    async def stream_books(cls, session: AsyncSession, chunk_size: int) -> AsyncIterator[Sequence[RowMapping]]:
+        # Серверный курсор: строки приходят пачками по chunk_size, ORM-объекты не создаются
+        query = book_card_query().order_by(BookOrm.id).execution_options(yield_per=chunk_size)
+        result = await session.stream(query)
+        async for rows in result.mappings().partitions():
+            yield rows
 
     @classmethod
-    async def get_existing_author(cls, author_data):
-        author = await AuthorRepository.get_author_by_details(author_data)
-        return author
+    async def get_book_by_id(cls, session: AsyncSession, id: int) -> dict | None:
+        [book] = await get_cached(session, [book_key(id)])
+        if book is not None:
+            return book
+        result = await session.execute(book_card_query().where(BookOrm.id == id))
+        row = result.first()
+        if row is None:
+            return None
+        book = book_row_to_dict(row)
+        await set_cached(session, {book_key(id): (book, book_tags(book))})
+        return book
 
     @classmethod
-    async def get_books(cls) -> List[SchemaBook]:
-        async with new_session() as session:
-            query = select(BookOrm).options(joinedload(BookOrm.author))
-            result = await session.execute(query)
-            books = result.scalars().all()
-
-            schema_books = []
-            for book in books:
-                author_data = None
-                if book.author:
-                    author_data = {
-                        'id': book.author.id,
-                        'first_name': book.author.first_name,
-                        'last_name': book.author.last_name,
-                        'birth_date': book.author.birth_date.strftime('%Y-%m-%d') if book.author.birth_date else None
-                    }
-
-                schema_books.append(SchemaBook(
-                    id=book.id,
-                    title=book.title,
-                    description=book.description,
-                    available_copies=book.available_copies,
-                    author=SchemaAuthor(**author_data) if author_data else None
-                ))
-
-            return schema_books
+    async def get_book_etag(cls, session: AsyncSession, id: int) -> str | None:
+        [book] = await get_cached(session, [book_key(id)])
+        if book is not None:
+            return book_etag(book)
+        result = await session.execute(book_versions_query(id))
+        row = result.first()
+        if row is None:
+            return None
+        version, author_version = row
+        return make_etag(id, version, author_version or 0)
 
     @classmethod
-    async def get_book_by_id(cls, id: int) -> SchemaBook | dict[str, None]:
-        async with new_session() as session:
-            query = select(BookOrm).where(BookOrm.id == id).options(joinedload(BookOrm.author))
-            book_orm = await session.execute(query)
-            book = book_orm.scalars().first()
-
-            if book:
-                author_data = None
-                if book.author:
-                    author_data = {
-                        'id': book.author.id,
-                        'first_name': book.author.first_name,
-                        'last_name': book.author.last_name,
-                        'birth_date': book.author.birth_date.strftime('%Y-%m-%d') if book.author.birth_date else None
-                    }
-
-                return SchemaBook(
-                    id=book.id,
-                    title=book.title,
-                    description=book.description,
-                    available_copies=book.available_copies,
-                    author=SchemaAuthor(**author_data) if author_data else None
-                )
+    async def update_book(cls, session: AsyncSession, book_id: int, book_data: dict,
+                          expected_etag: str | None = None) -> dict | None:
+        values = {key: book_data[key] for key in ('title', 'description') if key in book_data}
+        # Не переданный остаток не меняется
+        if book_data.get('available_copies') is not None:
+            values['available_copies'] = book_data['available_copies']
+
+        statement = update(BookOrm).where(BookOrm.id == book_id)
+        if expected_etag is not None:
+            # ETag книги включает версию автора: она тоже должна совпасть
+            expected = expected_versions(expected_etag, book_id, 3)
+            author_version = (select(AuthorOrm.version)
+                              .where(AuthorOrm.id == BookOrm.author_id)
+                              .scalar_subquery())
+            statement = statement.where(BookOrm.version == expected[1],
+                                        func.coalesce(author_version, 0) == expected[2])
+
+        statement = statement.values(**values, version=BookOrm.version + 1).returning(
+            BookOrm.id, BookOrm.title, BookOrm.description, BookOrm.available_copies,
+            BookOrm.author_id, BookOrm.version)
+        try:
+            if IS_POSTGRES:
+                row = await cls._update_book_with_author(session, statement, book_data.get('author'))
             else:
-                return None
-
-
-    # @classmethod
-    # async def update_book(cls, id: int, book: Book) -> Book:
-    #     async with new_session() as session:
-    #         stored_book = await session.get(BookOrm, id)
-    #         if stored_book:
-    #             # Обновление данных книги
-    #             for key, value in book.model_dump().items():
-    #                 if key not in ['author', 'available_copies']:
-    #                     setattr(stored_book, key, value)
-    #                     getattr(stored_book, 'available_copies')
-    #
-    #             # Проверяем наличие информации об авторе в книге
-    #             if 'author' not in book.model_dump():
-    #                 # Создаем нового автора на основе данных из словаря author_data
-    #                 model = Author.model_dump(book.author)
-    #                 new_author = AuthorOrm(**model)
-    #                 session.add(new_author)
-    #                 await session.commit()
-    #
-    #                 # Привязываем нового автора к книге
-    #                 stored_book.author = new_author
-    #             else:
-    #                 # Обновляем автора книги, если он существует
-    #                 author_id = book.model_dump().get('author')
-    #                 if author_id:
-    #                     author = await session.get(AuthorOrm, id)
-    #                     if author:
-    #                         stored_book.author = author
-    #
-    #             await session.commit()
-    #
-    #             return stored_book
-
-    # @classmethod
-    # async def update_book(cls, book_id: int, book_data: dict):
-    #     async with new_session() as session:
-    #         stored_book = await session.get(BookOrm, book_id)
-    #         if stored_book:
-    #             for key, value in book_data.items():
-    #                 if key not in ['author', 'available_copies']:
-    #                     if key in ['available_copies']:
-    #                         getattr(stored_book, 'available_copies')
-    #                     setattr(stored_book, key, value)
-    #
-    #             if 'author' in book_data:
-    #                 author_data = book_data['author']
-    #
-    #                 if author_data:
-    #                     new_author = AuthorOrm(**author_data)
-    #                     session.add(new_author)
-    #                     await session.flush()
-    #
-    #                     stored_book.author = new_author
-    #
-    #             await session.commit()
-    #             return stored_book
-    #         return None
+                row = await cls._update_book_in_steps(session, statement, book_data.get('author'))
+        except IntegrityError:
+            # У автора уже есть книга с таким названием (uq_book_identity)
+            await session.rollback()
+            raise DuplicateError("У этого автора уже есть книга с таким названием.")
+        if row is None:
+            if expected_etag is not None and await session.scalar(select(BookOrm.id).where(BookOrm.id == book_id)):
+                raise VersionConflictError("Книга была изменена другим запросом.")
+            return None
+        await session.commit()
+        await invalidate_books(book_id)
+        await reindex_books(session, BookOrm.id == book_id)
+        return book_row_to_dict(row)
 
     @classmethod
-    async def update_book(cls, book_id: int, book_data: dict):
-        async with new_session() as session:
-            stored_book = await session.get(BookOrm, book_id)
-            if stored_book:
-
-                for key, value in book_data.items():
-                    if key not in ['author', 'available_copies']:
-                        setattr(stored_book, key, value)
-
-                if 'author' in book_data:
-                    author_data = book_data['author']
-                    if author_data:
-                        # Проверяем, существует ли автор
-                        existing_author = await session.get(AuthorOrm, author_data.get('id'))
-                        if existing_author:
-                            # Обновляем существующего автора
-                            for attr, attr_value in author_data.items():
-                                setattr(existing_author, attr, attr_value)
-                        else:
-                            # Создаем нового автора, если не найден
-                            new_author = AuthorOrm(**author_data)
-                            session.add(new_author)
-                            stored_book.author = new_author
-                if 'available_copies' in book_data:
-                    # Если значение передано, обновляем его
-                    stored_book.available_copies = book_data['available_copies']
-                else:
-                    # Если значение не передано, используем текущее значение
-                    stored_book.available_copies = stored_book.available_copies
-
-                await session.commit()
-                return stored_book
+    async def _update_book_with_author(cls, session: AsyncSession, statement, author_data: dict | None):
+        # Новый автор пишется upsert-ом в CTE того же запроса
+        author = None
+        if author_data:
+            author = (AuthorRepository.upsert_author_statement(author_data)
+                      .returning(*AUTHOR_COLUMNS).cte('author_upsert'))
+            statement = statement.values(author_id=select(author.c.id).scalar_subquery())
+        updated = statement.cte('book_update')
+        # Карточка собирается тем же запросом: автор берётся из CTE, если он
+        # записан сейчас, иначе из таблицы
+        author_source = author if author is not None else AuthorOrm.__table__
+        result = await session.execute(
+            select(updated.c.id, updated.c.title, updated.c.description, updated.c.available_copies,
+                   updated.c.author_id, updated.c.version,
+                   author_source.c.first_name, author_source.c.last_name,
+                   author_source.c.birth_date, author_source.c.version)
+            .outerjoin(author_source, updated.c.author_id == author_source.c.id)
+        )
+        return result.first()
 
+    @classmethod
+    async def _update_book_in_steps(cls, session: AsyncSession, statement, author_data: dict | None):
+        # SQLite: без изменяющих CTE автор, книга и карточка автора -- отдельные запросы
+        author = None
+        if author_data:
+            result = await session.execute(
+                AuthorRepository.upsert_author_statement(author_data).returning(*AUTHOR_COLUMNS))
+            author = result.one()
+            statement = statement.values(author_id=author.id)
+        book = (await session.execute(statement)).first()
+        if book is None:
             return None
-
-
+        if author is None and book.author_id is not None:
+            author = (await session.execute(select(*AUTHOR_COLUMNS).where(AuthorOrm.id == book.author_id))).one()
+        return (*book, *(author[1:] if author is not None else (None,) * 4))
 
     @classmethod
-    async def delete_book(cls, id: int) -> BookOrm:
-        async with new_session() as session:
-            book_to_delete = await session.get(BookOrm, id)
-            if book_to_delete:
-                await session.delete(book_to_delete)
-                await session.commit()
-                return book_to_delete
+    async def delete_book(cls, session: AsyncSession, id: int) -> dict | None:
+        # Блокировка строки книги: параллельная выдача (условный UPDATE остатка)
+        # ждёт коммита, и открытая выдача не появится после проверки ниже
+        result = await session.execute(book_card_query().where(BookOrm.id == id).with_for_update(of=BookOrm))
+        row = result.first()
+        if row is None:
             return None
+        if await session.scalar(select(exists().where(BorrowOrm.book_id == id, BorrowOrm.return_date.is_(None)))):
+            raise BookBorrowedError("Книгу нельзя удалить: не все копии возвращены.")
+        # История выдач не загружается в память: закрытые выдачи переносятся в
+        # borrow_archive (он переживает удаление книги) двумя запросами
+        columns = [BorrowOrm.__table__.c[name] for name in ARCHIVE_COLUMNS]
+        await session.execute(insert(BorrowArchiveOrm).from_select(
+            ARCHIVE_COLUMNS, select(*columns).where(BorrowOrm.book_id == id)))
+        await session.execute(delete(BorrowOrm).where(BorrowOrm.book_id == id))
+        await session.execute(delete(BookOrm).where(BookOrm.id == id))
+        await session.commit()
+        await invalidate_books(id)
+        if USE_SEARCH_INDEX:
+            book_index.remove(id)
+        return book_row_to_dict(row)
 
     @classmethod
-    async def borrow_book(cls, book_id: int):
-        async with new_session() as session:
-            book = await session.get(BookOrm, book_id)
-            if book:
-                if book.available_copies > 0:
-                    book.available_copies -= 1
-                    await session.commit()
-                    return True
-                else:
-                    raise ValueError("Все копии книги 'на руках'.")
-            else:
-                raise ValueError("Книга не найдена.")
+    async def borrow_book(cls, session: AsyncSession, book_id: int):
+        # Условный UPDATE: уменьшаем остаток только если есть свободная копия,
+        # поэтому параллельные выдачи не могут увести его в минус
+        result = await session.execute(
+            update(BookOrm)
+            .where(BookOrm.id == book_id, BookOrm.available_copies > 0)
+            .values(available_copies=BookOrm.available_copies - 1, version=BookOrm.version + 1)
+            .returning(BookOrm.available_copies)
+        )
+        if result.scalar_one_or_none() is None:
+            book_exists = await session.scalar(select(BookOrm.id).where(BookOrm.id == book_id))
+            if book_exists is None:
+                raise BookNotFoundError("Книга не найдена.")
+            raise BookNotAvailableError("Все копии книги 'на руках'.")
+        # Кэш сбрасывает вызывающий после коммита: сброс до коммита дал бы
+        # параллельному чтению закэшировать старый остаток
+        return True
 
     @classmethod
-    async def return_book(cls, book_id: int):
-        async with new_session() as session:
-            book = await session.get(BookOrm, book_id)
-            if book:
-                book.available_copies += 1
-                await session.commit()
+    async def return_book(cls, session: AsyncSession, book_id: int):
+        await session.execute(
+            update(BookOrm)
+            .where(BookOrm.id == book_id)
+            .values(available_copies=BookOrm.available_copies + 1, version=BookOrm.version + 1)
+        )
 
 class BorrowRepository:
     @classmethod
-    async def create_borrow(cls, borrow_data: dict) -> BorrowOrm:
+    async def create_borrow(cls, session: AsyncSession, borrow_data: dict) -> BorrowOrm:
         borrower_name = borrow_data.get("borrower_name")
         book_id = borrow_data.get("book_id")
         borrow_date = borrow_data.get("borrow_date")
@@ -324,52 +823,54 @@ class BorrowRepository:
         elif not isinstance(borrow_date, (datetime, date)):
             raise ValueError("borrow_date должен быть строкой или объектом datetime.")
 
-        async with new_session() as session:
-            new_borrow = BorrowOrm(
-                borrower_name=borrower_name,
-                book_id=book_id,
-                borrow_date=borrow_date
-            )
-            session.add(new_borrow)
-            await BookRepository.borrow_book(book_id)
-            await session.commit()
-            return new_borrow
+        await BookRepository.borrow_book(session, book_id)
+        new_borrow = BorrowOrm(
+            borrower_name=borrower_name,
+            book_id=book_id,
+            borrow_date=borrow_date
+        )
+        session.add(new_borrow)
+        await session.commit()
+        await invalidate_books(book_id)
+        return new_borrow
 
     @classmethod
-    async def get_borrows(cls) -> List[BorrowOrm]:
-        async with new_session() as session:
-            query = select(BorrowOrm)
-            result = await session.execute(query)
-            borrows = result.scalars().all()
-            return borrows
+    async def get_borrows(cls, session: AsyncSession, limit: int, after: list | None = None,
+                          since: date | None = None) -> list[dict]:
+        result = await session.execute(borrows_page_query(limit, after, since))
+        return [borrow_row_to_dict(row) for row in result]
 
     @classmethod
-    async def get_borrow_by_id(cls, id: int) -> BorrowOrm:
-        async with new_session() as session:
-            borrow = await session.get(BorrowOrm, id)
-            return borrow
+    async def stream_borrows(cls, session: AsyncSession, chunk_size: int) -> AsyncIterator[Sequence[RowMapping]]:
+        query = (select(*BORROW_COLUMNS)
+                 .order_by(BorrowOrm.id)
+                 .execution_options(yield_per=chunk_size))
+        result = await session.stream(query)
+        async for rows in result.mappings().partitions():
+            yield rows
 
     @classmethod
-    async def return_borrow(cls, borrow_id: int, return_date_str: str) -> BorrowOrm:
-        async with new_session() as session:
-            # Получаем запись о займе
-            borrow_to_return = await session.get(BorrowOrm, borrow_id)
-            if borrow_to_return:
-                # Преобразуем строку в объект date
-                try:
-                    return_date = datetime.strptime(return_date_str, '%Y-%m-%d').date()
-                except ValueError:
-                    raise ValueError("Неверный формат даты. Ожидается формат YYYY-MM-DD.")
-
-                    # Устанавливаем дату возврата
-                borrow_to_return.return_date = return_date
-
-                # Возвращаем книгу
-                await BookRepository.return_book(borrow_to_return.book_id)
-
-                await session.commit()  # Сохраняем изменения
-                return borrow_to_return
-
-            return None
-
+    async def get_borrow_by_id(cls, session: AsyncSession, id: int) -> dict | None:
+        result = await session.execute(select(*BORROW_COLUMNS).where(BorrowOrm.id == id))
+        row = result.first()
+        return borrow_row_to_dict(row) if row else None
 
+    @classmethod
+    async def return_borrow(cls, session: AsyncSession, borrow_id: int, return_date: date) -> BorrowOrm:
+        # Закрываем только открытую выдачу: повторный возврат не обновит ни одной
+        # строки и не увеличит остаток книги второй раз
+        result = await session.execute(
+            update(BorrowOrm)
+            .where(BorrowOrm.id == borrow_id, BorrowOrm.return_date.is_(None))
+            .values(return_date=return_date)
+            .returning(BorrowOrm)
+        )
+        returned_borrow = result.scalars().first()
+        if returned_borrow is None:
+            # Выдачи нет или она уже закрыта
+            return await session.get(BorrowOrm, borrow_id)
+
+        await BookRepository.return_book(session, returned_borrow.book_id)
+        await session.commit()
+        await invalidate_books(returned_borrow.book_id)
+        return returned_borrow
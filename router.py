@@ -1,102 +1,153 @@
 from datetime import date
-from typing import List
+from typing import List, Literal, Optional
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
 from fastapi.openapi.docs import get_swagger_ui_html
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
-from main import app
-from models import Book, Borrow, Author, SchemaAuthor, SchemaBook
-from repository import AuthorRepository, BookRepository, BorrowRepository
+from database import consistency_headers, get_read_session, get_session
+from main import app, etag_response, if_match_etag, not_modified, page_response
+from models import Book, Borrow, Author, SchemaAuthor, SchemaBook, SchemaBarrow
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, paginate
+from repository import AuthorRepository, BookRepository, BorrowRepository, BookBorrowedError, BookNotFoundError, BookNotAvailableError
+from repository import DuplicateError, VersionConflictError, author_etag, book_etag, borrow_etag
 
 router = APIRouter()
 app.include_router(router)
 @router.post("/", response_model=Author)
-async def create_author_route(author: Author):
-    author_id = await AuthorRepository.create_author(author)
+async def create_author_route(author: Author, session: AsyncSession = Depends(get_session)):
+    author_id = await AuthorRepository.create_author(session, author)
     return {"author_id": author_id}
 
-@router.get("/authors", response_model=List[Author])
-async def get_authors_route():
-    authors = await AuthorRepository.get_authors()
-    return authors
-
-@router.get("/authors/{id}", response_model=Author)
-async def get_author_by_id_route(id: int):
-    author = await AuthorRepository.get_author_by_id(id)
+@router.get("/authors", response_model=List[SchemaAuthor])
+async def get_authors_route(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                            after: Optional[str] = None,
+                            if_none_match: Optional[str] = Header(None),
+                            session: AsyncSession = Depends(get_read_session)):
+    authors = await AuthorRepository.get_authors(session, limit + 1, decode_cursor(after, 'id'))
+    return page_response(*paginate(authors, limit, 'id'), author_etag, if_none_match)
+
+@router.get("/authors/{id}", response_model=SchemaAuthor)
+async def get_author_by_id_route(id: int,
+                                 if_none_match: Optional[str] = Header(None),
+                                 session: AsyncSession = Depends(get_read_session)):
+    if if_none_match is not None:
+        response = not_modified(if_none_match, await AuthorRepository.get_author_etag(session, id))
+        if response:
+            return response
+    author = await AuthorRepository.get_author_by_id(session, id)
     if author:
-        return author
-    return {"error": "Author not found"}
+        return etag_response(author, author_etag(author))
+    raise HTTPException(status_code=404, detail="Author not found")
 
 @router.put("/authors/{id}", response_model=Author)
-async def update_author_route(id: int, author: Author):
-    updated_author = await AuthorRepository.update_author(id, author)
+async def update_author_route(id: int, author: Author,
+                              if_match: Optional[str] = Header(None),
+                              session: AsyncSession = Depends(get_session)):
+    try:
+        updated_author = await AuthorRepository.update_author(session, id, author.model_dump(), if_match_etag(if_match))
+    except VersionConflictError as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except DuplicateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if updated_author:
-        return updated_author
+        return etag_response(updated_author, author_etag(updated_author), headers=consistency_headers(session))
     return {"error": "Author not found"}
 
 @router.delete("/authors/{id}", response_model=SchemaAuthor)
-async def delete_author_route(id: int):
-    deleted_author = await AuthorRepository.delete_author(id)
+async def delete_author_route(id: int, session: AsyncSession = Depends(get_session)):
+    deleted_author = await AuthorRepository.delete_author(session, id)
     if deleted_author:
         return deleted_author
     raise HTTPException(status_code=404, detail="Author not found")
 
 @router.post("/book", response_model=Book)
-async def create_book_route(book: Book):
+async def create_book_route(book: Book, session: AsyncSession = Depends(get_session)):
     book_data = book.model_dump()
     if 'author' not in book_data:
         raise ValueError("Key 'author' is missing in book_data")
 
-    new_book = await BookRepository.create_book(book)
+    new_book = await BookRepository.create_book(session, book)
     return new_book
 
-@router.get("/books", response_model=List[Book])
-async def get_books_route():
-    books = await BookRepository.get_books()
-    return books
+@router.get("/books", response_model=List[SchemaBook])
+async def get_books_route(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                          after: Optional[str] = None,
+                          order_by: Literal['id', 'title'] = 'id',
+                          if_none_match: Optional[str] = Header(None),
+                          session: AsyncSession = Depends(get_read_session)):
+    books = await BookRepository.get_books(session, limit + 1, decode_cursor(after, order_by), order_by)
+    return page_response(*paginate(books, limit, order_by), book_etag, if_none_match)
 
 @router.get("/books/{id}", response_model=SchemaBook)
-async def get_book_by_id_route(id: int):
-    book = await BookRepository.get_book_by_id(id)
+async def get_book_by_id_route(id: int,
+                               if_none_match: Optional[str] = Header(None),
+                               session: AsyncSession = Depends(get_read_session)):
+    if if_none_match is not None:
+        response = not_modified(if_none_match, await BookRepository.get_book_etag(session, id))
+        if response:
+            return response
+    book = await BookRepository.get_book_by_id(session, id)
     if book:
-        return book
-    return {"error": "Book not found"}
+        return etag_response(book, book_etag(book))
+    raise HTTPException(status_code=404, detail="Book not found")
 
 @router.put("/books/{id}", response_model=SchemaBook, response_model_exclude={"author"})
-async def update_book_route(id: int, book: Book):
-    updated_book = await BookRepository.update_book(id, book)
+async def update_book_route(id: int, book: Book,
+                            if_match: Optional[str] = Header(None),
+                            session: AsyncSession = Depends(get_session)):
+    try:
+        updated_book = await BookRepository.update_book(session, id, book.model_dump(), if_match_etag(if_match))
+    except VersionConflictError as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except DuplicateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if updated_book:
         return updated_book
     return {"error": "Book not found"}
 
 @router.delete("/books/{id}", response_model=SchemaBook)
-async def delete_book_route(id: int):
-    deleted_book = await BookRepository.delete_book(id)
+async def delete_book_route(id: int, session: AsyncSession = Depends(get_session)):
+    try:
+        deleted_book = await BookRepository.delete_book(session, id)
+    except BookBorrowedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if deleted_book:
         return deleted_book
     return {"error": "Book not found"}
 
 @router.post("/borrows", response_model=Borrow)
-async def create_borrow_route(borrow: Borrow):
-    new_borrow = await BorrowRepository.create_borrow(borrow)
+async def create_borrow_route(borrow: Borrow, session: AsyncSession = Depends(get_session)):
+    try:
+        new_borrow = await BorrowRepository.create_borrow(session, borrow.model_dump())
+    except BookNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except BookNotAvailableError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     return new_borrow
 
-@router.get("/borrows", response_model=List[Borrow])
-async def get_borrows_route():
-    borrows = await BorrowRepository.get_borrows()
-    return borrows
-
-@router.get("/borrows/{id}", response_model=Borrow)
-async def get_borrow_by_id_route(id: int):
-    borrow = await BorrowRepository.get_borrow_by_id(id)
+@router.get("/borrows", response_model=List[SchemaBarrow])
+async def get_borrows_route(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                            after: Optional[str] = None,
+                            since: Optional[date] = None,
+                            if_none_match: Optional[str] = Header(None),
+                            session: AsyncSession = Depends(get_read_session)):
+    borrows = await BorrowRepository.get_borrows(session, limit + 1, decode_cursor(after, 'id'), since)
+    return page_response(*paginate(borrows, limit, 'id'), borrow_etag, if_none_match)
+
+@router.get("/borrows/{id}", response_model=SchemaBarrow)
+async def get_borrow_by_id_route(id: int,
+                                 if_none_match: Optional[str] = Header(None),
+                                 session: AsyncSession = Depends(get_read_session)):
+    borrow = await BorrowRepository.get_borrow_by_id(session, id)
     if borrow:
-        return borrow
-    return {"error": "Borrow not found"}
+        return etag_response(borrow, borrow_etag(borrow), if_none_match)
+    raise HTTPException(status_code=404, detail="Borrow not found")
 
 @router.patch("/borrows/{id}/return", response_model=Borrow)
-async def return_borrow_route(id: int, return_date: date):
-    returned_borrow = await BorrowRepository.return_borrow(id, return_date)
+async def return_borrow_route(id: int, return_date: date, session: AsyncSession = Depends(get_session)):
+    returned_borrow = await BorrowRepository.return_borrow(session, id, return_date)
     if returned_borrow:
         return returned_borrow
     return {"error": "Borrow not found"}
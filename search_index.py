@@ -0,0 +1,152 @@
+import bisect
+import heapq
+import math
+import re
+from array import array
+from collections import Counter
+from typing import Iterable
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Название весит вдвое больше описания и имени автора (как вес A против B в tsvector)
+TITLE_WEIGHT = 2
+MAX_TERM_FREQUENCY = 0xFFFF
+
+
+def tokenize(text: str | None) -> list[str]:
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+class SearchIndex:
+    # Инвертированный индекс в памяти процесса с ранжированием BM25.
+    # Постинги терма -- два параллельных массива: id документов по возрастанию
+    # и частоты терма, без отдельного объекта на каждое вхождение
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: dict[str, tuple[array, array]] = {}
+        # Отсортированный словарь: префикс запроса раскрывается двоичным поиском
+        self._terms: list[str] = []
+        self._doc_terms: dict[int, tuple[str, ...]] = {}
+        self._doc_length: dict[int, int] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_length)
+
+    def clear(self) -> None:
+        self._postings.clear()
+        self._terms.clear()
+        self._doc_terms.clear()
+        self._doc_length.clear()
+        self._total_length = 0
+
+    def build(self, documents: Iterable[tuple[int, str, str | None, str | None]]) -> None:
+        # Полное построение: словарь сортируется один раз в конце
+        self.clear()
+        for doc_id, title, description, author in documents:
+            if doc_id in self._doc_length:
+                self._remove(doc_id)
+            self._add(doc_id, title, description, author)
+        self._terms = sorted(self._postings)
+
+    def add(self, doc_id: int, title: str, description: str | None = None, author: str | None = None) -> None:
+        self.remove(doc_id)
+        for term in self._add(doc_id, title, description, author):
+            bisect.insort(self._terms, term)
+
+    def remove(self, doc_id: int) -> None:
+        for term in self._remove(doc_id):
+            del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def _add(self, doc_id: int, title: str, description: str | None, author: str | None) -> list[str]:
+        counts = Counter()
+        for term in tokenize(title):
+            counts[term] += TITLE_WEIGHT
+        counts.update(tokenize(description))
+        counts.update(tokenize(author))
+
+        new_terms = []
+        for term, frequency in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array('I'), array('H'))
+                new_terms.append(term)
+            ids, frequencies = postings
+            frequency = min(frequency, MAX_TERM_FREQUENCY)
+            if not ids or ids[-1] < doc_id:
+                ids.append(doc_id)
+                frequencies.append(frequency)
+            else:
+                position = bisect.bisect_left(ids, doc_id)
+                ids.insert(position, doc_id)
+                frequencies.insert(position, frequency)
+
+        length = sum(counts.values())
+        self._doc_terms[doc_id] = tuple(counts)
+        self._doc_length[doc_id] = length
+        self._total_length += length
+        return new_terms
+
+    def _remove(self, doc_id: int) -> list[str]:
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return []
+        self._total_length -= self._doc_length.pop(doc_id)
+        emptied = []
+        for term in terms:
+            ids, frequencies = self._postings[term]
+            position = bisect.bisect_left(ids, doc_id)
+            del ids[position]
+            del frequencies[position]
+            if not ids:
+                del self._postings[term]
+                emptied.append(term)
+        return emptied
+
+    def _expand(self, prefix: str) -> list[str]:
+        start = bisect.bisect_left(self._terms, prefix)
+        end = bisect.bisect_left(self._terms, prefix + '\U0010ffff', start)
+        return self._terms[start:end]
+
+    def search(self, q: str, limit: int, after: list | None = None) -> list[tuple[float, int]]:
+        # Каждое слово запроса -- префикс, документ должен содержать все слова.
+        # Результат -- (score, id) по убыванию score, при равенстве по id;
+        # after -- курсор [score, id] последней строки предыдущей страницы
+        words = list(dict.fromkeys(tokenize(q)))
+        if not words or not self._doc_length:
+            return []
+        expansions = [self._expand(word) for word in words]
+        # Сначала самые редкие слова: пересечение сразу становится маленьким
+        expansions.sort(key=lambda terms: sum(len(self._postings[term][0]) for term in terms))
+
+        documents = len(self._doc_length)
+        average_length = self._total_length / documents
+        scores: dict[int, float] | None = None
+        for terms in expansions:
+            word_scores: dict[int, float] = {}
+            for term in terms:
+                ids, frequencies = self._postings[term]
+                idf = math.log(1 + (documents - len(ids) + 0.5) / (len(ids) + 0.5))
+                for doc_id, frequency in zip(ids, frequencies):
+                    if scores is not None and doc_id not in scores:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_length[doc_id] / average_length)
+                    word_scores[doc_id] = word_scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+            if scores is not None:
+                for doc_id in word_scores:
+                    word_scores[doc_id] += scores[doc_id]
+            scores = word_scores
+            if not scores:
+                return []
+
+        hits = ((score, doc_id) for doc_id, score in scores.items())
+        if after is not None:
+            after_score, after_id = after
+            hits = ((score, doc_id) for score, doc_id in hits
+                    if score < after_score or (score == after_score and doc_id > after_id))
+        return heapq.nsmallest(limit, hits, key=lambda hit: (-hit[0], hit[1]))
+
+
+# Индекс каталога для баз без полнотекстового поиска Postgres
+book_index = SearchIndex()
@@ -0,0 +1,98 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+from archive import ArchiveProgress, archive_batch, archive_returned_borrows
+from database import BorrowArchiveOrm, BorrowOrm, engine
+from models import Book
+from repository import BookRepository
+
+CUTOFF = datetime(2024, 1, 1)
+OLD = datetime(2020, 1, 1)
+RETURNED_OLD = datetime(2020, 2, 1)
+RECENT = datetime(2025, 1, 1)
+
+
+async def add_borrows(session, *dates) -> list[int]:
+    # dates -- пары (borrow_date, return_date); id выдач в порядке пар
+    book = await BookRepository.create_book(session, Book(title='Dune', author=None))
+    borrows = [BorrowOrm(book_id=book.id, borrower_name='Paul', borrow_date=borrow_date, return_date=return_date)
+               for borrow_date, return_date in dates]
+    session.add_all(borrows)
+    await session.commit()
+    return [borrow.id for borrow in borrows]
+
+
+async def ids_in(session, model) -> list[int]:
+    return list((await session.scalars(select(model.id).order_by(model.id))).all())
+
+
+def test_progress_tracks_batches_and_resume_point(timer):
+    progress = ArchiveProgress(timer=timer)
+    progress.start(datetime(2025, 1, 1), after_id=10)
+
+    progress.record([11, 12, 15])
+    timer.now = 2
+    progress.record([16, 20])
+    progress.finish()
+
+    stats = progress.stats()
+    assert stats['last_id'] == 20
+    assert stats['batches'] == 2
+    assert stats['moved'] == 5
+    assert stats['rows_per_second'] == 2.5
+    assert not stats['running']
+
+
+def test_new_run_resets_counters_but_keeps_totals(timer):
+    progress = ArchiveProgress(timer=timer)
+    progress.start(datetime(2025, 1, 1), after_id=0)
+    progress.record([1, 2])
+    progress.finish(RuntimeError('connection lost'))
+    assert progress.stats()['error'] == 'connection lost'
+
+    progress.start(datetime(2025, 1, 1), after_id=2)
+    stats = progress.stats()
+    assert (stats['moved'], stats['total_moved'], stats['runs'], stats['error']) == (0, 2, 2, None)
+
+
+@pytest.mark.asyncio
+async def test_only_returned_borrows_older_than_cutoff_are_archived(session, timer):
+    old_returned, old_open, recent_returned = await add_borrows(
+        session, (OLD, RETURNED_OLD), (OLD, None), (RECENT, RECENT))
+
+    stats = await archive_returned_borrows(CUTOFF, 10, progress=ArchiveProgress(timer=timer))
+
+    assert stats['moved'] == 1
+    assert await ids_in(session, BorrowArchiveOrm) == [old_returned]
+    assert await ids_in(session, BorrowOrm) == [old_open, recent_returned]
+    archived = await session.get(BorrowArchiveOrm, old_returned)
+    assert (archived.borrow_date, archived.return_date) == (OLD, RETURNED_OLD)
+
+
+@pytest.mark.asyncio
+async def test_resumed_run_skips_ids_up_to_after_id(session, timer):
+    first, second, third = await add_borrows(session, *[(OLD, RETURNED_OLD)] * 3)
+
+    stats = await archive_returned_borrows(CUTOFF, 10, after_id=first, progress=ArchiveProgress(timer=timer))
+
+    assert stats['last_id'] == third
+    assert await ids_in(session, BorrowArchiveOrm) == [second, third]
+    assert await ids_in(session, BorrowOrm) == [first]
+
+
+@pytest.mark.asyncio
+async def test_batch_size_bounds_every_pass(session, timer):
+    ids = await add_borrows(session, *[(OLD, RETURNED_OLD)] * 5)
+
+    async with engine.begin() as connection:
+        assert await archive_batch(connection, CUTOFF, 0, 2) == ids[:2]
+
+    resume_points = []
+    stats = await archive_returned_borrows(CUTOFF, 2, after_id=ids[1], progress=ArchiveProgress(timer=timer),
+                                           on_batch=lambda batch: resume_points.append(batch['last_id']))
+
+    assert resume_points == [ids[3], ids[4]]
+    assert (stats['batches'], stats['moved']) == (2, 3)
+    assert await ids_in(session, BorrowArchiveOrm) == ids
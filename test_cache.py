@@ -0,0 +1,88 @@
+import pytest
+
+from cache import MemoryCache, RedisCache, TTLCache
+
+
+def test_get_counts_hits_and_misses(timer):
+    cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+    cache.set(1, {'id': 1})
+
+    assert cache.get(1) == {'id': 1}
+    assert cache.get(2) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_entries_expire_after_ttl(timer):
+    cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+    cache.set(1, 'book')
+
+    timer.now = 59
+    assert cache.get(1) == 'book'
+    timer.now = 60
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted(timer):
+    cache = TTLCache(maxsize=2, ttl=60, timer=timer)
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    cache.get(1)
+    cache.set(3, 'c')
+
+    assert cache.get(2) is None
+    assert cache.get(1) == 'a'
+    assert cache.get(3) == 'c'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_evict_if_removes_matching_entries(timer):
+    cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+    cache.set(1, {'author': {'id': 7}})
+    cache.set(2, {'author': {'id': 8}})
+
+    cache.evict_if(lambda book: book['author']['id'] == 7)
+
+    assert cache.get(1) is None
+    assert cache.get(2) == {'author': {'id': 8}}
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_invalidates_by_tag():
+    cache = MemoryCache(maxsize=10, ttl=60)
+    await cache.set_many({'book:1': ({'id': 1}, ['author:7']), 'book:2': ({'id': 2}, ['author:8'])})
+
+    await cache.invalidate_tags('author:7')
+
+    assert await cache.get_many(['book:1', 'book:2']) == [None, {'id': 2}]
+
+
+@pytest.mark.asyncio
+async def test_redis_cache_round_trip_and_tag_invalidation():
+    fakeredis = pytest.importorskip('fakeredis')
+    cache = RedisCache(fakeredis.FakeAsyncRedis(), ttl=60)
+    await cache.set_many({
+        'book:1': ({'id': 1, 'author': {'id': 7}}, ['author:7']),
+        'book:2': ({'id': 2, 'author': None}, []),
+    })
+
+    assert await cache.get_many(['book:1', 'book:2', 'book:3']) == [
+        {'id': 1, 'author': {'id': 7}}, {'id': 2, 'author': None}, None]
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+    await cache.invalidate_tags('author:7')
+    assert await cache.get_many(['book:1', 'book:2']) == [None, {'id': 2, 'author': None}]
+
+
+@pytest.mark.asyncio
+async def test_redis_cache_rounds_fractional_ttl_up():
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeAsyncRedis()
+    cache = RedisCache(client, ttl=0.5)
+    await cache.set_many({'book:1': ({'id': 1}, ['author:7'])})
+
+    assert cache.ttl == 1
+    assert await client.ttl('library:book:1') == 1
+    assert RedisCache(client, ttl=60.2).ttl == 61
@@ -48,7 +48,7 @@ async def test_create_book_with_author(book_data, new_db_session, author_data):
         }
 
     author_orm = AuthorOrm(**author_data)
-    author_id = await AuthorRepository.create_author(author_orm)
+    author_id = await AuthorRepository.create_author(new_db_session, author_orm)
     assert author_id is not None
 
     book_data["author_id"] = author_id
@@ -60,7 +60,7 @@ async def test_create_book_with_author(book_data, new_db_session, author_data):
         for existing_book in existing_books:
             await check_book(existing_book, author_id)
 
-        book = await BookRepository.create_book(book_data)
+        book = await BookRepository.create_book(new_db_session, book_data)
 
     assert book is not None
 
@@ -81,7 +81,7 @@ async def test_create_book_without_existing_author(book_data, new_db_session, au
         }
 
     author_orm = AuthorOrm(**author_data)
-    author_id = await AuthorRepository.create_author(author_orm)
+    author_id = await AuthorRepository.create_author(new_db_session, author_orm)
 
     query = select(AuthorOrm).filter(
         (AuthorOrm.first_name == author_data['first_name']) &
@@ -95,10 +95,10 @@ async def test_create_book_without_existing_author(book_data, new_db_session, au
 
         if existing_author is None:
             with pytest.raises(ValueError) as e:
-                await BookRepository.create_book(book_data, author_id=author_id)
+                await BookRepository.create_book(new_db_session, book_data, author_id=author_id)
             assert str(e.value) == "Сначала создайте автора !"
         else:
-            book = await BookRepository.create_book(book_data,)
+            book = await BookRepository.create_book(new_db_session, book_data,)
             return book
 
 
@@ -121,11 +121,11 @@ async def test_get_authors(new_db_session):
     author_orm_1 = AuthorOrm(**author_data_1)
     author_orm_2 = AuthorOrm(**author_data_2)
 
-    await AuthorRepository.create_author(author_orm_1)
-    await AuthorRepository.create_author(author_orm_2)
+    await AuthorRepository.create_author(new_db_session, author_orm_1)
+    await AuthorRepository.create_author(new_db_session, author_orm_2)
 
     # Вызов метода get_authors для получения списка авторов
-    authors = await AuthorRepository.get_authors()
+    authors = await AuthorRepository.get_authors(new_db_session, limit=100)
 
     # Проверка, что возвращенный результат является списком
     assert isinstance(authors, list)
@@ -139,7 +139,7 @@ async def test_get_books(new_db_session):
 
         session.execute = AsyncMock(return_value=mock_result)
 
-        books = await BookRepository.get_books()
+        books = await BookRepository.get_books(new_db_session, limit=100)
         assert isinstance(books, list)
 
 @pytest.mark.asyncio
@@ -154,12 +154,12 @@ async def delete_book(cls, id: int) -> BookOrm:
 
 @pytest.mark.asyncio
 async def test_create_borrow(borrow_data, new_db_session):
-    borrow = await BorrowRepository.create_borrow(borrow_data)
+    borrow = await BorrowRepository.create_borrow(new_db_session, borrow_data)
     assert borrow is not None
 
 @pytest.mark.asyncio
 async def test_get_borrows(new_db_session):
-    borrows = await BorrowRepository.get_borrows()
+    borrows = await BorrowRepository.get_borrows(new_db_session, limit=100)
     assert isinstance(borrows, list)
 
 # pytest test_database.py
\ No newline at end of file
@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+
+import database
+from config import settings
+
+
+def books_by_title(client) -> dict:
+    return {book['title']: book for book in client.get('/books').json()}
+
+
+def test_bulk_import_merges_duplicates_and_reports_bad_rows(client):
+    body = (
+        b'{"title": "Dune", "author": {"first_name": "Frank", "last_name": "Herbert"}}\n'
+        b'{"title": "dune ", "author": {"first_name": " frank", "last_name": "HERBERT"}, "available_copies": 2}\n'
+        b'{"author": {"first_name": "Frank"}}\n'
+        b'{not json\n'
+        b'{"title": "Emma", "available_copies": 0}\n'
+        b'{"title": "Emma"}\n'
+    )
+
+    report = client.post('/books/bulk', content=body, headers={'content-type': 'application/x-ndjson'}).json()
+
+    assert (report['imported'], report['failed']) == (4, 3)
+    assert [error['line'] for error in report['errors']] == [3, 4, 5]
+    books = books_by_title(client)
+    assert sorted(books) == ['Dune', 'Emma']
+    assert books['Dune']['available_copies'] == 3
+    assert books['Dune']['author']['last_name'] == 'Herbert'
+
+
+def test_bulk_import_reads_csv_with_multiline_and_stray_quotes(client):
+    body = (
+        b'title,description,author_first_name,author_last_name,available_copies\n'
+        b'Dune,"Desert\nplanet",Frank,Herbert,1\n'
+        b'The 5" Floppy,disk,,,1\n'
+        b'Emma,,Jane,Austen,2\n'
+    )
+
+    report = client.post('/books/bulk', content=body, headers={'content-type': 'text/csv'}).json()
+
+    assert report == {'imported': 4, 'failed': 0, 'errors': []}
+    books = books_by_title(client)
+    assert books['Dune']['description'] == 'Desert\nplanet'
+    assert books['The 5" Floppy']['author'] is None
+    assert books['Emma']['available_copies'] == 2
+
+
+def import_books(client, count: int) -> None:
+    lines = [json.dumps({'title': f'Book {number}', 'description': f'Part {number}, "draft"\nsecond line'})
+             for number in range(count)]
+    client.post('/books/bulk', content='\n'.join(lines).encode())
+
+
+def test_ndjson_export_streams_every_row_past_yield_per(client, monkeypatch):
+    monkeypatch.setattr(settings, 'EXPORT_CHUNK_SIZE', 2)
+    import_books(client, 5)
+
+    response = client.get('/books/export')
+
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row['title'] for row in rows] == [f'Book {number}' for number in range(5)]
+
+
+def test_csv_export_escapes_commas_quotes_and_newlines(client, monkeypatch):
+    monkeypatch.setattr(settings, 'EXPORT_CHUNK_SIZE', 2)
+    import_books(client, 5)
+
+    response = client.get('/books/export', params={'format': 'csv'})
+
+    assert response.headers['content-type'].startswith('text/csv')
+    assert '"Part 0, ""draft""\nsecond line"' in response.text
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == 5
+    assert rows[0]['description'] == 'Part 0, "draft"\nsecond line'
+
+
+def test_borrow_export_lists_every_borrow(client, monkeypatch):
+    monkeypatch.setattr(settings, 'EXPORT_CHUNK_SIZE', 2)
+    client.post('/books/bulk', content=b'{"title": "Dune", "available_copies": 3}\n')
+    book_id = client.get('/books').json()[0]['id']
+    for name in ('Paul', 'Jessica', 'Leto'):
+        client.post('/borrows', json={'book_id': book_id, 'borrower_name': name, 'borrow_date': '2024-01-02'})
+
+    response = client.get('/borrows/export', params={'format': 'csv'})
+
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row['borrower_name'] for row in rows] == ['Paul', 'Jessica', 'Leto']
+
+
+def test_exports_pass_the_consistency_token_to_the_read_session(client, monkeypatch):
+    tokens = []
+    choose_session = database.new_consistent_read_session
+
+    async def recording_session(token):
+        tokens.append(token)
+        return await choose_session(token)
+
+    monkeypatch.setattr(database, 'new_consistent_read_session', recording_session)
+    import_books(client, 2)
+
+    books = client.get('/books/export', headers={'X-Consistency-Token': '0/16B3748'})
+    borrows = client.get('/borrows/export', params={'format': 'csv'}, headers={'X-Consistency-Token': '0/16B3748'})
+
+    assert tokens == ['0/16B3748', '0/16B3748']
+    assert len(books.text.splitlines()) == 2
+    assert borrows.status_code == 200
+
+
+def test_conditional_get_answers_304_until_the_book_changes(client):
+    client.post('/books/bulk', content=b'{"title": "Dune", "author": {"last_name": "Herbert"}}\n')
+    book_id = client.get('/books').json()[0]['id']
+    etag = client.get(f'/books/{book_id}').headers['ETag']
+
+    cached = client.get(f'/books/{book_id}', headers={'If-None-Match': etag})
+    stale = client.get(f'/books/{book_id}', headers={'If-None-Match': '"0.0.0"'})
+
+    assert (cached.status_code, cached.content, cached.headers['ETag']) == (304, b'', etag)
+    assert (stale.status_code, stale.json()['title']) == (200, 'Dune')
+
+    client.put(f'/books/{book_id}', json={'title': 'Dune', 'description': 'Arrakis', 'author': None})
+    changed = client.get(f'/books/{book_id}', headers={'If-None-Match': etag})
+
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert changed.json()['description'] == 'Arrakis'
+
+
+def test_author_etag_changes_after_update(client):
+    client.post('/books/bulk', content=b'{"title": "Dune", "author": {"last_name": "Herbert"}}\n')
+    author_id = client.get('/authors').json()[0]['id']
+    # Обработчик GET /authors/{id} берёт id автора из параметра запроса author_id
+    url, params = f'/authors/{author_id}', {'author_id': author_id}
+    etag = client.get(url, params=params).headers['ETag']
+
+    assert client.get(url, params=params, headers={'If-None-Match': etag}).status_code == 304
+    client.put(url, json={'first_name': 'Frank', 'last_name': 'Herbert'})
+
+    assert client.get(url, params=params, headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_weak_etag_in_if_match_is_a_failed_precondition(client):
+    client.post('/books/bulk', content=b'{"title": "Dune"}\n')
+    book_id = client.get('/books').json()[0]['id']
+    etag = client.get(f'/books/{book_id}').headers['ETag']
+    changes = {'title': 'Dune', 'description': 'Arrakis', 'author': None}
+
+    assert client.put(f'/books/{book_id}', json=changes, headers={'If-Match': f'W/{etag}'}).status_code == 412
+    assert client.put(f'/books/{book_id}', json=changes, headers={'If-Match': etag}).status_code == 200
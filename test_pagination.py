@@ -0,0 +1,68 @@
+import pytest
+
+from models import Author, Book
+from pagination import InvalidCursorError, decode_cursor, encode_cursor, paginate
+from repository import BookRepository
+
+
+def test_cursor_round_trip():
+    token = encode_cursor('title', ['Dune', 7])
+    assert decode_cursor(token, 'title') == ['Dune', 7]
+
+
+def test_decode_cursor_rejects_other_ordering():
+    token = encode_cursor('id', [7])
+    with pytest.raises(InvalidCursorError):
+        decode_cursor(token, 'title')
+
+
+def test_decode_cursor_rejects_garbage():
+    with pytest.raises(InvalidCursorError):
+        decode_cursor('not-a-cursor', 'id')
+
+
+def test_paginate_sets_next_cursor_only_when_more_rows():
+    rows = [{'id': 1}, {'id': 2}, {'id': 3}]
+
+    page, next_cursor = paginate(rows, 2, 'id')
+    assert page == [{'id': 1}, {'id': 2}]
+    assert decode_cursor(next_cursor, 'id') == [2]
+
+    page, next_cursor = paginate(rows, 3, 'id')
+    assert len(page) == 3
+    assert next_cursor is None
+
+
+@pytest.mark.asyncio
+async def test_title_pages_neither_skip_nor_repeat_equal_titles(session):
+    # Три "Dune" разных авторов (или без автора) ложатся на границу страниц
+    for title, author in [('Dune', Author(last_name='Herbert')), ('Arrakis', None), ('Dune', None),
+                          ('Emma', None), ('Dune', Author(last_name='Anderson'))]:
+        await BookRepository.create_book(session, Book(title=title, author=author))
+
+    seen, after = [], None
+    while True:
+        books = await BookRepository.get_books(session, 2 + 1, after, 'title')
+        page, next_cursor = paginate(books, 2, 'title')
+        seen.extend((book['title'], book['id']) for book in page)
+        if next_cursor is None:
+            break
+        after = decode_cursor(next_cursor, 'title')
+
+    assert [title for title, _ in seen] == ['Arrakis', 'Dune', 'Dune', 'Dune', 'Emma']
+    assert seen == sorted(set(seen))
+
+
+def test_last_page_has_no_next_cursor(client):
+    client.post('/books/bulk', content=b'{"title": "Dune"}\n{"title": "Emma"}\n{"title": "Solaris"}\n')
+
+    first = client.get('/books', params={'limit': 2})
+    last = client.get('/books', params={'limit': 2, 'after': first.headers['X-Next-Cursor']})
+
+    assert [book['title'] for book in last.json()] == ['Solaris']
+    assert 'X-Next-Cursor' not in last.headers
+
+
+def test_malformed_cursor_is_a_bad_request(client):
+    assert client.get('/books', params={'after': 'not-a-cursor'}).status_code == 400
+    assert client.get('/books', params={'after': encode_cursor('id', [1]), 'order_by': 'title'}).status_code == 400
@@ -0,0 +1,39 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import text
+
+from database import IS_POSTGRES, engine
+from models import Author, Book
+from partitions import add_months, create_partition_sql, ensure_borrow_partitions, partition_name
+from repository import BookRepository, BorrowRepository
+
+HERBERT = Author(first_name='Frank', last_name='Herbert', birth_date=date(1920, 10, 8))
+
+
+def test_add_months_rolls_over_year():
+    assert add_months(date(2026, 11, 1), 2) == date(2027, 1, 1)
+    assert add_months(date(2026, 1, 1), -1) == date(2025, 12, 1)
+
+
+def test_partition_covers_one_calendar_month():
+    assert partition_name(date(2026, 2, 1)) == 'borrow_2026_02'
+    assert create_partition_sql(date(2026, 12, 17)) == (
+        'CREATE TABLE IF NOT EXISTS borrow_2026_12 PARTITION OF borrow '
+        "FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')")
+
+
+@pytest.mark.asyncio
+async def test_partition_takes_over_rows_from_default_partition(session):
+    if not IS_POSTGRES:
+        pytest.skip('секционирование есть только в Postgres')
+    book = await BookRepository.create_book(session, Book(title='Dune', author=HERBERT))
+    borrow = await BorrowRepository.create_borrow(
+        session, {'book_id': book.id, 'borrower_name': 'Paul', 'borrow_date': date(2031, 5, 2)})
+
+    created = await ensure_borrow_partitions(engine, 1, today=date(2031, 4, 10))
+
+    assert created == ['borrow_2031_04', 'borrow_2031_05']
+    location = await session.scalar(text('SELECT tableoid::regclass::text FROM borrow WHERE id = :id'), {'id': borrow.id})
+    assert location == 'borrow_2031_05'
+    assert await ensure_borrow_partitions(engine, 1, today=date(2031, 4, 10)) == []
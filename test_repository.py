@@ -0,0 +1,239 @@
+from datetime import date
+
+import pytest
+
+import repository
+from database import CACHE_FILL, CACHE_READ, IS_POSTGRES, BorrowArchiveOrm, new_session
+from models import Author, Book
+from repository import AuthorRepository, BookRepository, BorrowRepository
+from repository import USE_SEARCH_INDEX, BookBorrowedError, BookNotAvailableError, BookNotFoundError, DuplicateError
+from repository import VersionConflictError
+from repository import SearchUnavailableError, book_etag, book_key, invalidate_books
+from search_index import book_index
+
+HERBERT = Author(first_name='Frank', last_name='Herbert', birth_date=date(1920, 10, 8))
+
+
+async def add_book(session, title='Dune', author=HERBERT):
+    return await BookRepository.create_book(session, Book(title=title, author=author))
+
+
+def borrow_of(book_id):
+    return {'book_id': book_id, 'borrower_name': 'Paul', 'borrow_date': date(2024, 1, 2)}
+
+
+@pytest.mark.asyncio
+async def test_borrow_takes_copies_until_none_left(session):
+    book = await add_book(session)
+    await add_book(session)
+
+    await BorrowRepository.create_borrow(session, borrow_of(book.id))
+    await BorrowRepository.create_borrow(session, borrow_of(book.id))
+    with pytest.raises(BookNotAvailableError):
+        await BorrowRepository.create_borrow(session, borrow_of(book.id))
+
+    assert (await BookRepository.get_book_by_id(session, book.id))['available_copies'] == 0
+
+
+@pytest.mark.asyncio
+async def test_borrow_of_missing_book_is_not_found(session):
+    with pytest.raises(BookNotFoundError):
+        await BorrowRepository.create_borrow(session, borrow_of(404))
+
+
+@pytest.mark.asyncio
+async def test_second_return_changes_nothing(session):
+    book = await add_book(session)
+    borrow = await BorrowRepository.create_borrow(session, borrow_of(book.id))
+
+    first = await BorrowRepository.return_borrow(session, borrow.id, date(2024, 2, 1))
+    second = await BorrowRepository.return_borrow(session, borrow.id, date(2024, 3, 1))
+
+    assert first.return_date.date() == second.return_date.date() == date(2024, 2, 1)
+    assert (await BookRepository.get_book_by_id(session, book.id))['available_copies'] == 1
+    assert await BorrowRepository.return_borrow(session, 404, date(2024, 2, 1)) is None
+
+
+@pytest.mark.asyncio
+async def test_book_is_deleted_only_when_every_copy_is_back(session):
+    book_id = (await add_book(session)).id
+    borrow_id = (await BorrowRepository.create_borrow(session, borrow_of(book_id))).id
+
+    with pytest.raises(BookBorrowedError):
+        await BookRepository.delete_book(session, book_id)
+
+    await BorrowRepository.return_borrow(session, borrow_id, date(2024, 2, 1))
+    deleted = await BookRepository.delete_book(session, book_id)
+
+    assert (deleted['id'], deleted['author']['last_name']) == (book_id, 'Herbert')
+    assert await BookRepository.get_book_by_id(session, book_id) is None
+    assert await BorrowRepository.get_borrow_by_id(session, borrow_id) is None
+    assert (await session.get(BorrowArchiveOrm, borrow_id)).book_id == book_id
+    assert await BookRepository.delete_book(session, book_id) is None
+
+
+@pytest.mark.asyncio
+async def test_update_book_with_stale_etag_is_rejected(session):
+    book = await add_book(session)
+    version = book.version
+    etag = await BookRepository.get_book_etag(session, book.id)
+    changes = Book(title='Dune', author=HERBERT, description='Arrakis').model_dump()
+
+    updated = await BookRepository.update_book(session, book.id, changes, etag)
+    with pytest.raises(VersionConflictError):
+        await BookRepository.update_book(session, book.id, changes, etag)
+
+    assert updated['version'] == version + 1
+    assert await BookRepository.get_book_etag(session, book.id) == book_etag(updated)
+    assert await BookRepository.update_book(session, 404, changes) is None
+
+
+@pytest.mark.asyncio
+async def test_retitling_book_into_existing_title_of_author_is_a_conflict(session):
+    dune_id = (await add_book(session)).id
+    messiah_id = (await add_book(session, title='Dune Messiah')).id
+    changes = Book(title=' DUNE', author=HERBERT).model_dump()
+
+    with pytest.raises(DuplicateError):
+        await BookRepository.update_book(session, messiah_id, changes)
+
+    assert (await BookRepository.get_book_by_id(session, messiah_id))['title'] == 'Dune Messiah'
+    assert (await BookRepository.get_book_by_id(session, dune_id))['available_copies'] == 1
+
+
+@pytest.mark.asyncio
+async def test_update_author_with_stale_etag_is_rejected(session):
+    author = await AuthorRepository.create_author(session, HERBERT)
+    etag = await AuthorRepository.get_author_etag(session, author.id)
+    changes = {'first_name': 'Franklin', 'last_name': 'Herbert', 'birth_date': HERBERT.birth_date}
+
+    updated = await AuthorRepository.update_author(session, author.id, changes, etag)
+    with pytest.raises(VersionConflictError):
+        await AuthorRepository.update_author(session, author.id, changes, etag)
+
+    assert updated['first_name'] == 'Franklin'
+    assert (await AuthorRepository.get_author_by_id(session, author.id))['version'] == updated['version']
+
+
+@pytest.mark.asyncio
+async def test_renaming_author_into_another_identity_is_a_conflict(session):
+    herbert_id = (await AuthorRepository.create_author(session, HERBERT)).id
+    lem_id = (await AuthorRepository.create_author(session, Author(first_name='Stanislaw', last_name='Lem'))).id
+    changes = {'first_name': 'FRANK ', 'last_name': 'herbert', 'birth_date': HERBERT.birth_date}
+
+    with pytest.raises(DuplicateError):
+        await AuthorRepository.update_author(session, lem_id, changes)
+
+    assert (await AuthorRepository.get_author_by_id(session, lem_id))['last_name'] == 'Lem'
+    assert (await AuthorRepository.get_author_by_id(session, herbert_id))['first_name'] == 'Frank'
+
+
+@pytest.mark.asyncio
+async def test_create_author_reuses_row_with_same_normalized_identity(session):
+    first = await AuthorRepository.create_author(session, HERBERT)
+    again = await AuthorRepository.create_author(
+        session, Author(first_name=' frank ', last_name='HERBERT', birth_date=HERBERT.birth_date))
+    nameless = await AuthorRepository.create_author(session, Author(last_name='Lem'))
+    nameless_again = await AuthorRepository.create_author(session, Author(last_name='lem'))
+
+    assert again.id == first.id
+    assert nameless_again.id == nameless.id != first.id
+
+
+@pytest.mark.asyncio
+async def test_bulk_import_trims_only_spaces_like_btrim(session):
+    tabbed = Author(first_name='Frank\t', last_name='Herbert')
+    books = [(Book(title='Dune', author=HERBERT), 1), (Book(title=' Dune ', author=HERBERT), 1),
+             (Book(title='\u00a0Dune', author=HERBERT), 1), (Book(title='Dune', author=tabbed), 1)]
+
+    assert await BookRepository.bulk_create_books(session, books) == [None] * 4
+
+    page = await BookRepository.get_books(session, 10)
+    assert sorted((book['title'], book['available_copies']) for book in page) == [
+        ('Dune', 1), ('Dune', 2), ('\u00a0Dune', 1)]
+    assert len({book['author']['id'] for book in page}) == 2
+
+
+@pytest.mark.asyncio
+async def test_delete_author_with_and_without_books(session):
+    lonely = await AuthorRepository.create_author(session, Author(first_name='Stanislaw', last_name='Lem'))
+    book = await add_book(session)
+
+    assert (await AuthorRepository.delete_author(session, lonely.id)).id == lonely.id
+    deleted = await AuthorRepository.delete_author(session, book.author_id)
+
+    assert deleted.last_name == 'Herbert'
+    assert await AuthorRepository.get_author_by_id(session, deleted.id) is None
+    assert (await BookRepository.get_book_by_id(session, book.id))['author'] is None
+    if USE_SEARCH_INDEX:
+        assert [book_id for _, book_id in book_index.search('dune', 10)] == [book.id]
+        assert book_index.search('herbert', 10) == []
+    assert await AuthorRepository.delete_author(session, lonely.id) is None
+
+
+@pytest.mark.asyncio
+async def test_create_book_adds_copy_of_known_book(session):
+    book = await add_book(session)
+    again = await add_book(session, title=' dune ', author=Author(first_name='FRANK', last_name='herbert',
+                                                                  birth_date=HERBERT.birth_date))
+
+    assert again.id == book.id
+    assert again.available_copies == 2
+
+
+@pytest.mark.asyncio
+async def test_delete_author_merges_book_into_authorless_twin(session):
+    authorless = await add_book(session, author=None)
+    book = await add_book(session)
+    borrow = await BorrowRepository.create_borrow(session, borrow_of(book.id))
+
+    await AuthorRepository.delete_author(session, book.author_id)
+
+    assert await BookRepository.get_book_by_id(session, book.id) is None
+    merged = await BookRepository.get_book_by_id(session, authorless.id)
+    assert merged['available_copies'] == 1
+    assert (await BorrowRepository.get_borrow_by_id(session, borrow.id))['book_id'] == authorless.id
+    if USE_SEARCH_INDEX:
+        assert [book_id for _, book_id in book_index.search('dune', 10)] == [authorless.id]
+
+
+@pytest.mark.asyncio
+async def test_cached_card_is_dropped_only_after_borrow_commits(session, monkeypatch):
+    book = await add_book(session)
+    await BookRepository.get_book_by_id(session, book.id)
+    original_commit = session.commit
+
+    async def commit_with_concurrent_read():
+        # Чтение другого запроса между изменением остатка и коммитом
+        async with new_session() as other:
+            await BookRepository.get_book_by_id(other, book.id)
+        await original_commit()
+
+    monkeypatch.setattr(session, 'commit', commit_with_concurrent_read)
+    await BorrowRepository.create_borrow(session, borrow_of(book.id))
+
+    async with new_session() as other:
+        assert (await BookRepository.get_book_by_id(other, book.id))['available_copies'] == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_flags_of_read_sessions(session):
+    book = await add_book(session)
+    await BookRepository.get_book_by_id(session, book.id)
+    await repository.cache.set_many({book_key(book.id): ({'id': book.id, 'stale': True}, ())})
+
+    async with new_session(info={CACHE_READ: False, CACHE_FILL: False}) as token_read:
+        assert 'stale' not in await BookRepository.get_book_by_id(token_read, book.id)
+    await invalidate_books(book.id)
+    async with new_session(info={CACHE_FILL: False}) as replica_read:
+        await BookRepository.get_book_by_id(replica_read, book.id)
+
+    assert await repository.cache.get_many([book_key(book.id)]) == [None]
+
+
+@pytest.mark.asyncio
+async def test_author_search_without_pg_trgm_is_unavailable(session):
+    if IS_POSTGRES:
+        pytest.skip('pg_trgm может быть установлен')
+    with pytest.raises(SearchUnavailableError):
+        await AuthorRepository.search_authors(session, 'herb', 10, 0.3)
@@ -0,0 +1,43 @@
+from search_index import SearchIndex
+
+
+def build_index():
+    index = SearchIndex()
+    index.build([
+        (1, 'Dune', 'Desert planet', 'Frank Herbert'),
+        (2, 'Dune Messiah', 'Sequel to Dune', 'Frank Herbert'),
+        (3, 'Children of Dune', 'Third book', 'Frank Herbert'),
+        (4, 'Solaris', 'Ocean planet', 'Stanislaw Lem'),
+    ])
+    return index
+
+
+def test_search_matches_prefixes_of_every_word():
+    index = build_index()
+
+    assert {doc_id for _, doc_id in index.search('dun', 10)} == {1, 2, 3}
+    assert [doc_id for _, doc_id in index.search('plan lem', 10)] == [4]
+    assert index.search('dune lem', 10) == []
+
+
+def test_search_pages_by_score_and_id():
+    index = build_index()
+    everything = index.search('dune', 10)
+
+    first_page = index.search('dune', 2)
+    second_page = index.search('dune', 2, after=list(first_page[-1]))
+
+    assert first_page + second_page == everything
+    assert [score for score, _ in everything] == sorted((score for score, _ in everything), reverse=True)
+
+
+def test_add_replaces_and_remove_forgets_document():
+    index = build_index()
+
+    index.add(4, 'Solaris', 'Ocean planet', 'Станислав Лем')
+    assert [doc_id for _, doc_id in index.search('лем', 10)] == [4]
+    assert index.search('stanislaw', 10) == []
+
+    index.remove(4)
+    assert index.search('solaris', 10) == []
+    assert len(index) == 3
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import main
+from config import settings
+from database import DATABASE_URL, engine, warm_up_pool
+
+
+@pytest.mark.asyncio
+async def test_prod_startup_only_warms_the_pool(session, monkeypatch):
+    calls = []
+
+    async def record(name, *args):
+        calls.append(name)
+
+    async def warm_up(pool_engine, *args):
+        calls.append(('warm_up', pool_engine))
+
+    monkeypatch.setattr(settings, 'STARTUP_MODE', 'prod')
+    monkeypatch.setattr(main, 'create_tables', lambda: record('create_tables'))
+    monkeypatch.setattr(main, 'delete_tables', lambda: record('delete_tables'))
+    monkeypatch.setattr(main, 'warm_up_pool', warm_up)
+    # Секции borrow -- тоже DDL: без BORROW_PARTITION_CHECK_INTERVAL их создаёт
+    # отдельное задание, а не воркер
+    monkeypatch.setattr(main, 'IS_POSTGRES', True)
+    monkeypatch.setattr(main, 'maintain_borrow_partitions', lambda *args: record('partitions'))
+
+    async with main.lifespan(main.app):
+        assert calls == [('warm_up', engine)]
+    assert calls == [('warm_up', engine)]
+
+
+@pytest.mark.asyncio
+async def test_warm_up_never_opens_more_connections_than_the_pool_holds():
+    # Без ограничения шестое соединение ждало бы pool_timeout и падало
+    small = create_async_engine(DATABASE_URL, poolclass=AsyncAdaptedQueuePool,
+                                pool_size=2, max_overflow=1, pool_timeout=0.5)
+
+    try:
+        await warm_up_pool(small, 6, [select(1)])
+        # Соединение сверх pool_size при возврате закрывается
+        assert small.pool.checkedin() == 2
+    finally:
+        await small.dispose()
@@ -0,0 +1,57 @@
+import pytest
+
+from utils import csv_records, etag_matches, iter_lines, ndjson_records, parse_etag
+
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+async def records(reader, *parts: bytes) -> list:
+    return [record async for record in reader(iter_lines(chunks(*parts)))]
+
+
+@pytest.mark.asyncio
+async def test_lines_are_split_across_chunk_boundaries():
+    lines = [line async for line in iter_lines(chunks(b'ti', b'tle\r\nDu', b'ne\nEmma'))]
+
+    assert lines == ['title', 'Dune', 'Emma']
+
+
+@pytest.mark.asyncio
+async def test_quoted_field_may_span_lines():
+    result = await records(csv_records, b'title,description\n', b'Dune,"Desert\n', b'planet, ""Arrakis"""\nEmma,\n')
+
+    assert result == [
+        (2, {'title': 'Dune', 'description': 'Desert\nplanet, "Arrakis"'}),
+        (4, {'title': 'Emma', 'description': ''}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_stray_quote_inside_unquoted_field_does_not_swallow_next_lines():
+    result = await records(csv_records, b'title,description\nThe 5" Floppy,disk\nEmma,novel\n')
+
+    assert result == [
+        (2, {'title': 'The 5" Floppy', 'description': 'disk'}),
+        (3, {'title': 'Emma', 'description': 'novel'}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_broken_records_are_reported_with_their_line():
+    csv_result = await records(csv_records, b'title,description\nDune\nEmma,"novel\n')
+    ndjson_result = await records(ndjson_records, b'{"title": "Dune"}\n\n[1]\n{oops\n')
+
+    assert [(line, type(error)) for line, error in csv_result] == [(2, ValueError), (3, ValueError)]
+    assert ndjson_result[0] == (1, {'title': 'Dune'})
+    assert [line for line, _ in ndjson_result[1:]] == [3, 4]
+    assert all(isinstance(error, ValueError) for _, error in ndjson_result[1:])
+
+
+def test_weak_etags_match_only_if_none_match():
+    assert etag_matches('"1.2.0", W/"7.3.1"', '"7.3.1"')
+    assert parse_etag('"7.3.1"') == (7, 3, 1)
+    with pytest.raises(ValueError):
+        parse_etag('W/"7.3.1"')
@@ -1,8 +1,151 @@
-import json
+import csv
+import hashlib
+import io
+from typing import Any, AsyncIterator, Iterable, Mapping
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def _json_default(value):
+    # date/datetime orjson сериализует сам; сюда попадают только pydantic-модели
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+def make_etag(*parts) -> str:
+    return '"' + '.'.join(str(part) for part in parts) + '"'
+
+def parse_etag(etag: str) -> tuple[int, ...]:
+    # Обратное к make_etag для ETag из целых чисел (id и версии). Разбирается
+    # для If-Match, а там сравнение строгое (RFC 9110, 13.1.1): слабый W/-тег
+    # не соответствует ни одной версии
+    try:
+        return tuple(int(part) for part in etag.strip().strip('"').split('.'))
+    except ValueError:
+        raise ValueError("Некорректный ETag.")
+
+def digest_etag(parts: list) -> str:
+    # Strong ETag страницы: хэш ETag-ов её элементов, а не сериализованного тела
+    return '"' + hashlib.blake2b(dumps(parts), digest_size=16).hexdigest() + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match сравнивает слабо: W/-тег совпадает с тем же strong ETag
+    if if_none_match.strip() == '*':
+        return True
+    return etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
 
 def json_to_dict(json_str):
-    return json.loads(json_str)
+    return orjson.loads(json_str)
 
 def dict_to_json(obj):
-    return json.dumps(obj)
+    return dumps(obj).decode()
+
+
+class ORJSONResponse(JSONResponse):
+    # Ответ по умолчанию для всего приложения. Обработчики, которые отдают
+    # готовые данные репозитория, возвращают его напрямую: тогда FastAPI не
+    # прогоняет их повторно через response_model и jsonable_encoder
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+async def ndjson_stream(partitions: AsyncIterator[Iterable[Mapping]]) -> AsyncIterator[bytes]:
+    # Одна JSON-строка на запись; в памяти держится только текущая пачка
+    async for rows in partitions:
+        yield b"".join(dumps(dict(row)) + b"\n" for row in rows)
+
+async def csv_stream(partitions: AsyncIterator[Iterable[Mapping]], fieldnames: list[str]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    async for rows in partitions:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # Режем поток байтов на строки, не дожидаясь конца тела запроса
+    tail = b""
+    async for chunk in chunks:
+        tail += chunk
+        *lines, tail = tail.split(b"\n")
+        for line in lines:
+            yield line.decode().rstrip("\r")
+    if tail:
+        yield tail.decode().rstrip("\r")
+
+async def ndjson_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | Exception]]:
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json_to_dict(line)
+        except ValueError as e:
+            yield line_number, e
+            continue
+        if not isinstance(record, dict):
+            yield line_number, ValueError("Ожидается JSON-объект.")
+            continue
+        yield line_number, record
+
+def in_quoted_field(line: str, quoted: bool) -> bool:
+    # Остаётся ли после строки открытым поле в кавычках. Правила те же, что у
+    # csv.reader: кавычка открывает поле только в его начале, "" внутри поля в
+    # кавычках -- экранированная кавычка, кавычка посреди поля без кавычек --
+    # обычный символ
+    field_start = not quoted
+    index = 0
+    while index < len(line):
+        char = line[index]
+        if quoted:
+            if char == '"':
+                if line.startswith('"', index + 1):
+                    index += 1
+                else:
+                    quoted = False
+        elif char == '"' and field_start:
+            quoted = True
+        field_start = not quoted and char == ','
+        index += 1
+    return quoted
 
+async def csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | Exception]]:
+    # Запись CSV может занимать несколько строк, если поле в кавычках содержит
+    # перевод строки: копим строки, пока поле в кавычках не закроется
+    fieldnames = None
+    pending = []
+    quoted = False
+    line_number = 0
+    record_line = 0
+    async for line in lines:
+        line_number += 1
+        if not pending:
+            record_line = line_number
+        pending.append(line)
+        quoted = in_quoted_field(line, quoted)
+        if quoted:
+            continue
+        text = "\n".join(pending)
+        pending = []
+        if not text.strip():
+            continue
+        row = next(csv.reader([text]))
+        if fieldnames is None:
+            fieldnames = row
+            continue
+        if len(row) != len(fieldnames):
+            yield record_line, ValueError(f"Ожидалось {len(fieldnames)} полей, получено {len(row)}.")
+            continue
+        yield record_line, dict(zip(fieldnames, row))
+    if pending:
+        yield record_line, ValueError("Незакрытая кавычка в конце файла.")